@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+asyncmemcache.py
+
+A non-blocking memcache client for Tornado's IOLoop.
+"""
+
+import binascii
+import collections
+import cPickle
+import functools
+import logging
+import os
+import re
+import socket
+import time
+import tornado.iostream
+import tornado.ioloop
+
+
+# value flags, compatible with python-memcached so that both clients can share keys.
+_FLAG_PICKLE = 1 << 0
+_FLAG_INTEGER = 1 << 1
+_FLAG_LONG = 1 << 2
+
+SERVER_MAX_KEY_LENGTH = 250
+_KEY_CONTROL_CHARACTERS = re.compile(r'[\x00-\x20\x7f]')
+
+
+class MemcachedKeyError(ValueError):
+    pass
+
+
+class Client(object):
+    """
+    A non-blocking memcache client for use from the IOLoop.  Every command takes a
+    callback, which is passed the command's result; as with python-memcached,
+    connection failures are logged and reported as a miss (None) or as False.
+    Each server gets a pool of up to 'pool_size' connections, and commands wait
+    for a free connection once the pool is exhausted.  A command that gets no
+    response within 'command_timeout' seconds fails, and closes its connection.
+    Keys are checked as python-memcached checks them, and bad ones raise
+    MemcachedKeyError.
+    """
+    def __init__(self, servers, pool_size = 4, connect_timeout = 1.0, command_timeout = 1.0, io_loop = None):
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self._pools = [
+            _ConnectionPool(_parse_server(s), pool_size, connect_timeout, command_timeout, self.io_loop)
+            for s in servers
+        ]
+
+        if not self._pools:
+            raise ValueError("Client requires at least one server.")
+
+    def get(self, key, callback):
+        _check_key(key)
+
+        def on_response(values):
+            callback(values.get(key) if values else None)
+
+        self._command(key, _GetCommand([key], on_response))
+
+    def get_multi(self, keys, callback):
+        by_pool = collections.defaultdict(list)
+
+        for key in keys:
+            _check_key(key)
+
+        for key in keys:
+            by_pool[self._pool_for(key)].append(key)
+
+        if not by_pool:
+            return callback(dict())
+
+        results = dict()
+        pending = [len(by_pool)]
+
+        def on_response(values):
+            if values:
+                results.update(values)
+
+            pending[0] -= 1
+
+            if not pending[0]:
+                callback(results)
+
+        for pool, pool_keys in by_pool.iteritems():
+            pool.execute(_GetCommand(pool_keys, on_response))
+
+    def set(self, key, value, time = 0, callback = None):
+        self._store('set', key, value, time, callback)
+
+    def add(self, key, value, time = 0, callback = None):
+        self._store('add', key, value, time, callback)
+
+    def delete(self, key, callback = None):
+        _check_key(key)
+        self._command(key, _SimpleCommand("delete {0}\r\n".format(key), "DELETED", callback))
+
+    def _store(self, verb, key, value, time, callback):
+        _check_key(key)
+        flags, data = _encode(value)
+        line = "{0} {1} {2} {3} {4}\r\n{5}\r\n".format(verb, key, flags, int(time), len(data), data)
+        self._command(key, _SimpleCommand(line, "STORED", callback))
+
+    def _command(self, key, command):
+        self._pool_for(key).execute(command)
+
+    def _pool_for(self, key):
+        if len(self._pools) == 1:
+            return self._pools[0]
+
+        # same key distribution as python-memcached's default.
+        server_hash = ((binascii.crc32(key) & 0xffffffff) >> 16) & 0x7fff
+        return self._pools[server_hash % len(self._pools)]
+
+
+class _ConnectionPool(object):
+    def __init__(self, address, size, connect_timeout, command_timeout, io_loop):
+        self.address = address
+        self.size = size
+        self.connect_timeout = connect_timeout
+        self.command_timeout = command_timeout
+        self.io_loop = io_loop
+        self._idle = []
+        self._count = 0
+        self._waiting = collections.deque()
+
+    def execute(self, command):
+        if self._idle:
+            self._run(self._idle.pop(), command)
+        elif self._count < self.size:
+            self._count += 1
+            _Connection(self, functools.partial(self._on_connect, command))
+        else:
+            self._waiting.append(command)
+
+    def _on_connect(self, command, connection):
+        if connection is None:
+            self._count -= 1
+            self._next()
+            command.fail()
+        else:
+            self._run(connection, command)
+
+    def _run(self, connection, command):
+        connection.run(command, self._release)
+
+    def _release(self, connection):
+        if connection.closed:
+            self._count -= 1
+        else:
+            self._idle.append(connection)
+
+        self._next()
+
+    def _discard(self, connection):
+        if connection in self._idle:
+            self._idle.remove(connection)
+            self._count -= 1
+
+    def _next(self):
+        if self._waiting:
+            self.execute(self._waiting.popleft())
+
+
+class _Connection(object):
+    def __init__(self, pool, callback):
+        self.pool = pool
+        self.closed = False
+        self._command = None
+        self._command_timeout = None
+        self._release = None
+        self._connect_callback = callback
+
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.stream = tornado.iostream.IOStream(sock, io_loop = pool.io_loop)
+        except socket.error:
+            logging.exception("Could not create memcache socket.")
+            self.closed = True
+            callback(None)
+            return
+
+        self.stream.set_close_callback(self._on_close)
+        self._connect_timeout = pool.io_loop.add_timeout(
+            time.time() + pool.connect_timeout,
+            self._on_connect_timeout
+        )
+        self.stream.connect(pool.address, self._on_connect)
+
+    def _on_connect(self):
+        # tornado reports refused connections as connected; the close hands back None.
+        error = self.stream.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+
+        if error:
+            logging.error("Could not connect to memcache at {0[0]}:{0[1]}: {1}".format(self.pool.address, os.strerror(error)))
+            self.stream.close()
+            return
+
+        self.pool.io_loop.remove_timeout(self._connect_timeout)
+        callback, self._connect_callback = self._connect_callback, None
+        callback(self)
+
+    def _on_connect_timeout(self):
+        logging.error("Timed out connecting to memcache at {0[0]}:{0[1]}.".format(self.pool.address))
+        self.stream.close()
+
+    def _on_close(self):
+        self.closed = True
+
+        if self._connect_callback:
+            self.pool.io_loop.remove_timeout(self._connect_timeout)
+            callback, self._connect_callback = self._connect_callback, None
+            callback(None)
+        elif self._command:
+            logging.error("Lost connection to memcache at {0[0]}:{0[1]}.".format(self.pool.address))
+            self._finish(None, failed = True)
+        else:
+            self.pool._discard(self)
+
+    def _on_command_timeout(self):
+        # a server that accepts connections but never answers would otherwise hold
+        # this connection forever; closing it fails the command.
+        self._command_timeout = None
+        logging.error("Timed out waiting for memcache at {0[0]}:{0[1]}.".format(self.pool.address))
+        self.stream.close()
+
+    def run(self, command, release):
+        self._command = command
+        self._release = release
+
+        if self.pool.command_timeout is not None:
+            self._command_timeout = self.pool.io_loop.add_timeout(
+                time.time() + self.pool.command_timeout,
+                self._on_command_timeout
+            )
+
+        command.start(self)
+
+    def _finish(self, result, failed = False):
+        command, self._command = self._command, None
+        release, self._release = self._release, None
+
+        if self._command_timeout is not None:
+            self.pool.io_loop.remove_timeout(self._command_timeout)
+            self._command_timeout = None
+
+        # release first, so that a callback which raises can't leak the connection, and
+        # keep its exception from the IOStream, which would close the connection under
+        # whichever command it was handed to next.
+        release(self)
+
+        try:
+            if failed:
+                command.fail()
+            else:
+                command.callback_with(result)
+        except Exception:
+            logging.exception("Uncaught exception in memcache callback.")
+
+
+class _GetCommand(object):
+    def __init__(self, keys, callback):
+        self.keys = keys
+        self.callback = callback
+        self.values = dict()
+
+    def start(self, connection):
+        self.connection = connection
+        connection.stream.write("get {0}\r\n".format(' '.join(self.keys)))
+        self._read_header()
+
+    def _read_header(self):
+        self.connection.stream.read_until("\r\n", self._on_header)
+
+    def _on_header(self, line):
+        parts = line.split()
+
+        if parts and parts[0] == "VALUE":
+            key, flags, length = parts[1], int(parts[2]), int(parts[3])
+            self.connection.stream.read_bytes(length + 2, functools.partial(self._on_value, key, flags))
+        elif parts and parts[0] == "END":
+            self.connection._finish(self.values)
+        else:
+            logging.error("Unexpected memcache response: {0!r}".format(line))
+            self.connection.stream.close()
+
+    def _on_value(self, key, flags, data):
+        try:
+            self.values[key] = _decode(flags, data[:-2])
+        except Exception:
+            logging.exception("Could not decode memcache value for {0}.".format(key))
+
+        self._read_header()
+
+    def callback_with(self, result):
+        self.callback(result)
+
+    def fail(self):
+        self.callback(None)
+
+
+class _SimpleCommand(object):
+    def __init__(self, line, success, callback):
+        self.line = line
+        self.success = success
+        self.callback = callback
+
+    def start(self, connection):
+        self.connection = connection
+        connection.stream.write(self.line)
+        connection.stream.read_until("\r\n", self._on_response)
+
+    def _on_response(self, line):
+        self.connection._finish(line.strip() == self.success)
+
+    def callback_with(self, result):
+        if self.callback:
+            self.callback(result)
+
+    def fail(self):
+        self.callback_with(False)
+
+
+def _check_key(key):
+    if not isinstance(key, str):
+        raise MemcachedKeyError("Key must be a str, not {0!r}.".format(type(key)))
+    if not key:
+        raise MemcachedKeyError("Key must not be empty.")
+    if len(key) > SERVER_MAX_KEY_LENGTH:
+        raise MemcachedKeyError("Key is longer than {0} bytes: {1!r}".format(SERVER_MAX_KEY_LENGTH, key[:32]))
+    if _KEY_CONTROL_CHARACTERS.search(key):
+        raise MemcachedKeyError("Key contains whitespace or control characters: {0!r}".format(key))
+
+def _encode(value):
+    if isinstance(value, str):
+        return 0, value
+    elif isinstance(value, bool):
+        return _FLAG_PICKLE, cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+    elif isinstance(value, int):
+        return _FLAG_INTEGER, str(value)
+    elif isinstance(value, long):
+        return _FLAG_LONG, str(value)
+    else:
+        return _FLAG_PICKLE, cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+
+def _decode(flags, data):
+    if flags & _FLAG_PICKLE:
+        return cPickle.loads(data)
+    elif flags & _FLAG_INTEGER:
+        return int(data)
+    elif flags & _FLAG_LONG:
+        return long(data)
+    return data
+
+def _parse_server(server):
+    if isinstance(server, tuple):
+        return server
+
+    host, _, port = server.partition(':')
+    return (host, int(port or 11211))
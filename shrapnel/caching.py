@@ -7,17 +7,29 @@ Created by Kurtiss Hare on 2010-02-25.
 Copyright (c) 2010 Medium Entertainment, Inc. All rights reserved.
 """
 
-import bisect
+import collections
 import confy
+import cPickle
 import functools
 import itertools
+import logging
+import marshal
+import math
 import os
+import random
+import sys
+import threading
+import time
 import types
+import zlib
+import instrument
 import security
 
 
-def cached():
+def cached(coalesce = False, lock_timeout = None, expires = 0, negative_expires = None, codec = None):
     def decorator(undecorated):
+        stats = _register_stats(undecorated, sys._getframe(1))
+
         @functools.wraps(undecorated)
         def decorated(*args, **kwargs):
             generator = undecorated(*args, **kwargs)
@@ -33,24 +45,68 @@ def cached():
             if isinstance(cache_key, unicode):
                 cache_key = cache_key.encode('ascii')
             
-            result = mc.get(cache_key)
+            result = _from_cache(stats.get(mc, cache_key), codec)
+            stats.count(result is not _MISSING)
 
-            if not result:
-                try:
-                    result = generator.next()
-                except StopIteration:
-                    pass
+            if result is _MISSING:
+                def produce():
+                    started = time.time()
+
+                    try:
+                        value = generator.next()
+                    except StopIteration:
+                        return None
+
+                    stats.compute_time.add(time.time() - started)
+                    stats.set(mc, cache_key, _to_cache(value, codec), _expiry(value, expires, negative_expires))
+                    return value
 
-                if result:
-                    mc.set(cache_key, result)
+                def peek():
+                    return _from_cache(mc.get(cache_key), codec)
+
+                fill = produce
+
+                if lock_timeout:
+                    fill = functools.partial(_leased, mc, cache_key, produce, peek, lock_timeout)
+
+                if coalesce:
+                    result = _single_flight((id(mc), cache_key), fill)
+                else:
+                    result = fill()
 
             return result
         return decorated
     return decorator
 
 
-def cached2(key_format, memcached_instance = '__default__'):
+def cached2(key_format, memcached_instance = '__default__', local_cache = None, expires = 0,
+            coalesce = False, lock_timeout = None, early_refresh = None, revalidate_after = None,
+            negative_expires = None, codec = None, namespace = None):
+    """
+    'expires' is the memcache expiry for stored values.  With 'coalesce', concurrent
+    misses for the same key within this process wait on a single computation.  With
+    'lock_timeout', a miss takes a lease on the key via memcache's add, and other
+    processes poll for the leaseholder's value for up to that many seconds before
+    computing it themselves.  They poll by sleeping, which blocks the calling
+    thread, so don't use 'lock_timeout' on the IOLoop.  The lease lasts for
+    'lock_timeout' rounded up to whole seconds, as memcache expiries are.
+    'early_refresh' (a beta, typically 1.0, requiring
+    'expires') probabilistically recomputes values shortly before they expire, in
+    proportion to how long they took to compute.  Values older than
+    'revalidate_after' seconds are returned as-is while a BackgroundFunction
+    recomputes them.  Falsy values (including None) are cached too, for
+    'negative_expires' seconds if that is given.  Values are serialized with
+    'codec' (see Codec) if one is given, or by the memcache client otherwise.
+    'namespace' is a format string (or a list of them), applied to the same format
+    arguments as 'key_format', naming families of keys which invalidate_namespace
+    can expire all at once.
+    """
+    enveloped = bool(early_refresh or revalidate_after)
+    namespaces = _namespaces(namespace)
+
     def decorator(undecorated):
+        stats = _register_stats(undecorated, sys._getframe(1), key_format)
+
         def raise_error(msg, *args, **kwargs):
             msg = msg.format(*args, **kwargs)
             msg = "{0.__name__} does not conform to the 'cached' protocol. {1}".format(undecorated, msg)
@@ -60,6 +116,9 @@ def cached2(key_format, memcached_instance = '__default__'):
             if not callable(getattr(key_format, 'format', None)):
                 raise_error("'key_format' must support the .format(...) method.")        
 
+        if early_refresh and not expires:
+            raise_error("'early_refresh' requires 'expires'.")
+
         @functools.wraps(undecorated)
         def decorated(*args, **kwargs):
             generator = undecorated(*args, **kwargs)
@@ -77,37 +136,857 @@ def cached2(key_format, memcached_instance = '__default__'):
             except StopIteration:
                 raise_error("It must yield format arguments to be applied to key_format.")
                 
-            if not isinstance(key_format_args, tuple):
-                key_format_args = (key_format_args,)
-
             try:
-                key = key_format.format(*key_format_args)
+                key = _format_key(key_format, key_format_args)
+                namespace_keys = [_namespace_key(n, key_format_args) for n in namespaces]
             except Exception, e:
                 raise_error(str(e))
 
-            if isinstance(key, unicode):
-                key = key.encode('ascii')
+            if namespace_keys:
+                key = _namespaced(key, namespace_keys, _generations(mc, memcached_instance, namespace_keys))
+
+            if local_cache is not None:
+                result = local_cache.get(key, _MISSING)
+
+                if result is not _MISSING:
+                    stats.count(True, local = True)
+                    return result
+
+            revalidate = False
+            stale = _MISSING
+            result = _from_cache(stats.get(mc, key), codec)
+            stats.count(result is not _MISSING)
+
+            if enveloped and result is not _MISSING:
+                envelope = _unenvelope(result)
+
+                if envelope is None:
+                    # stored before enveloping was enabled, so its age is unknown; treat it as stale.
+                    if revalidate_after:
+                        revalidate = True
+                        stale = result
+                    else:
+                        stale, result = result, _MISSING
+                else:
+                    result, stored_at, delta = envelope
 
-            result = mc.get(key)
+                    if revalidate_after and stored_at + revalidate_after <= time.time():
+                        revalidate = True
+                        stale = result
+                    elif early_refresh and _refresh_early(stored_at + expires, delta, early_refresh):
+                        stale, result = result, _MISSING
+
+            def produce():
+                started = time.time()
 
-            if not result:
                 try:
-                    result = generator.next()
+                    value = generator.next()
                 except StopIteration:
                     raise_error("It must yield a value after it yields format arguments.")
 
-                if result:
-                    mc.set(key, result)
+                entry = value
+                now = time.time()
+                stats.compute_time.add(now - started)
+
+                if enveloped:
+                    entry = _envelope(value, now, now - started)
+
+                stats.set(mc, key, _to_cache(entry, codec), _expiry(value, expires, negative_expires))
+                return value
+
+            def peek():
+                value = _from_cache(mc.get(key), codec)
+
+                if enveloped and value is not _MISSING:
+                    # until the leaseholder stores an envelope, there's no fresh value.
+                    envelope = _unenvelope(value)
+                    value = _MISSING if envelope is None else envelope[0]
+
+                return value
+
+            fill = produce
+
+            if lock_timeout:
+                fill = functools.partial(_leased, mc, key, produce, peek, lock_timeout, stale)
+
+            if revalidate:
+                callback = None
+
+                if local_cache is not None:
+                    callback = functools.partial(local_cache.set, key)
+
+                _revalidate((memcached_instance, key), fill, callback)
+            elif result is _MISSING:
+                if coalesce:
+                    result = _single_flight((memcached_instance, key), fill)
+                else:
+                    result = fill()
+
+            if local_cache is not None:
+                local_cache.set(key, result)
 
             return result
         return decorated
     return decorator    
-    
+
+
+def async_cached2(key_format, memcached_instance = '__default__', local_cache = None, expires = 0,
+                  negative_expires = None, codec = None):
+    """
+    A non-blocking variant of cached2 for use on the IOLoop.  The decorated generator
+    yields format arguments, then yields either a value or a callable which accepts
+    a callback and passes the value to it.  The decorated function takes a 'callback'
+    keyword argument, which receives the result.  The memcache client is looked up as
+    'async_memcache.<memcached_instance>' and must be callback-based, like
+    shrapnel.asyncmemcache.Client.
+    """
+    def decorator(undecorated):
+        stats = _register_stats(undecorated, sys._getframe(1), key_format)
+
+        def raise_error(msg, *args, **kwargs):
+            msg = msg.format(*args, **kwargs)
+            msg = "{0.__name__} does not conform to the 'async_cached' protocol. {1}".format(undecorated, msg)
+            raise RuntimeError(msg)
+
+        if not callable(getattr(key_format, 'format', None)):
+            raise_error("'key_format' must support the .format(...) method.")
+
+        @functools.wraps(undecorated)
+        def decorated(*args, **kwargs):
+            callback = kwargs.pop('callback', None)
+
+            if not callable(callback):
+                raise_error("It must be called with a 'callback' keyword argument.")
+
+            generator = undecorated(*args, **kwargs)
+
+            if not type(generator) == types.GeneratorType:
+                raise_error("It must return a generator.")
+
+            mc = confy.instance("async_memcache.{0}".format(memcached_instance))
+
+            try:
+                key_format_args = generator.next()
+            except StopIteration:
+                raise_error("It must yield format arguments to be applied to key_format.")
+
+            try:
+                key = _format_key(key_format, key_format_args)
+            except Exception, e:
+                raise_error(str(e))
+
+            if local_cache is not None:
+                result = local_cache.get(key, _MISSING)
+
+                if result is not _MISSING:
+                    stats.count(True, local = True)
+                    return callback(result)
+
+            def on_value(value):
+                stats.compute_time.add(time.time() - started[0])
+                encoded = _to_cache(value, codec)
+                stats.value_size_of(encoded)
+                set_started = time.time()
+                mc.set(key, encoded, _expiry(value, expires, negative_expires),
+                    callback = lambda stored: stats.set_time.add(time.time() - set_started))
+
+                if local_cache is not None:
+                    local_cache.set(key, value)
+
+                callback(value)
+
+            def on_get(result):
+                stats.get_time.add(time.time() - started[0])
+                result = _from_cache(result, codec)
+                stats.count(result is not _MISSING)
+
+                if result is not _MISSING:
+                    if local_cache is not None:
+                        local_cache.set(key, result)
+
+                    return callback(result)
+
+                try:
+                    producer = generator.next()
+                except StopIteration:
+                    raise_error("It must yield a value after it yields format arguments.")
+
+                started[0] = time.time()
+
+                if callable(producer):
+                    producer(on_value)
+                else:
+                    on_value(producer)
+
+            started = [time.time()]
+            mc.get(key, on_get)
+        return decorated
+    return decorator
+
+
+def cached2_multi(key_format, memcached_instance = '__default__', local_cache = None, expires = 0,
+                  negative_expires = None, codec = None, namespace = None):
+    """
+    Bulk variant of cached2.  The decorated generator first yields a list of
+    format arguments, one entry per value wanted.  It is then sent the list of
+    format arguments which missed the cache, and must yield either a list of
+    values for those misses (in the same order) or a callable, which will be
+    called once per miss with that miss's format arguments.  All keys are
+    resolved with a single get_multi, and misses are written back with a single
+    set_multi.  The decorated function returns a list of values in the order of
+    the format arguments.  'namespace' works as it does for cached2.
+    """
+    namespaces = _namespaces(namespace)
+
+    def decorator(undecorated):
+        stats = _register_stats(undecorated, sys._getframe(1), key_format)
+
+        def raise_error(msg, *args, **kwargs):
+            msg = msg.format(*args, **kwargs)
+            msg = "{0.__name__} does not conform to the 'cached_multi' protocol. {1}".format(undecorated, msg)
+            raise RuntimeError(msg)
+
+        if not callable(getattr(key_format, 'format', None)):
+            raise_error("'key_format' must support the .format(...) method.")
+
+        @functools.wraps(undecorated)
+        def decorated(*args, **kwargs):
+            generator = undecorated(*args, **kwargs)
+
+            if not type(generator) == types.GeneratorType:
+                raise_error("It must return a generator.")
+
+            mc = confy.instance("memcache.{0}".format(memcached_instance))
+
+            if not callable(getattr(mc, 'get_multi', None)) or not callable(getattr(mc, 'set_multi', None)):
+                raise_error("The <memcached> instance for this function must support the .get_multi(...) and .set_multi(...) methods.")
+
+            try:
+                all_format_args = list(generator.next())
+            except StopIteration:
+                raise_error("It must yield a list of format arguments to be applied to key_format.")
+            except TypeError:
+                raise_error("It must yield a list of format arguments to be applied to key_format.")
+
+            try:
+                keys = [_format_key(key_format, format_args) for format_args in all_format_args]
+                namespace_keys = [[_namespace_key(n, format_args) for n in namespaces] for format_args in all_format_args]
+            except Exception, e:
+                raise_error(str(e))
+
+            if namespaces:
+                generations = _generations(mc, memcached_instance, set(itertools.chain(*namespace_keys)))
+                keys = [_namespaced(key, nkeys, generations) for key, nkeys in itertools.izip(keys, namespace_keys)]
+
+            found = dict()
+
+            if local_cache is not None:
+                for key in keys:
+                    value = local_cache.get(key, _MISSING)
+
+                    if value is not _MISSING:
+                        found[key] = value
+
+                stats.count(True, local = True, n = len(found))
+
+            remote_keys = [key for key in set(keys) if key not in found]
+
+            if remote_keys:
+                remote = stats.get_multi(mc, remote_keys)
+                remote_hits = 0
+
+                for key, value in remote.iteritems():
+                    value = _from_cache(value, codec)
+
+                    if value is not _MISSING:
+                        found[key] = value
+                        remote_hits += 1
+
+                        if local_cache is not None:
+                            local_cache.set(key, value)
+
+                stats.count(True, n = remote_hits)
+                stats.count(False, n = len(remote_keys) - remote_hits)
+
+            missed_keys = []
+            missed_args = []
+            seen = set(found)
+
+            for key, format_args in itertools.izip(keys, all_format_args):
+                if key not in seen:
+                    seen.add(key)
+                    missed_keys.append(key)
+                    missed_args.append(format_args)
+
+            if missed_keys:
+                started = time.time()
+
+                try:
+                    producer = generator.send(missed_args)
+                except StopIteration:
+                    raise_error("It must yield values after it yields format arguments.")
+
+                if callable(producer):
+                    values = [producer(*_format_args_tuple(format_args)) for format_args in missed_args]
+                else:
+                    values = list(producer)
+
+                if len(values) != len(missed_keys):
+                    raise_error("It yielded {0} values for {1} misses.", len(values), len(missed_keys))
+
+                stats.compute_time.add(time.time() - started)
+                computed = collections.defaultdict(dict)
+
+                for key, value in itertools.izip(missed_keys, values):
+                    found[key] = value
+                    computed[_expiry(value, expires, negative_expires)][key] = _to_cache(value, codec)
+
+                    if local_cache is not None:
+                        local_cache.set(key, value)
+
+                for time_to_live, mapping in computed.iteritems():
+                    stats.set_multi(mc, mapping, time_to_live)
+
+            return [found[key] for key in keys]
+        return decorated
+    return decorator
+
+
+_MISSING = object()
+
+# how long, in seconds, a process may keep using a namespace generation it has read.
+NAMESPACE_TTL = 1.0
+
+def invalidate_namespace(namespace, memcached_instance = '__default__'):
+    """
+    Expires every cached2 value stored under 'namespace' (an already-formatted
+    namespace, such as "user:42") by bumping its generation.  Other processes
+    notice within NAMESPACE_TTL seconds.
+    """
+    mc = confy.instance("memcache.{0}".format(memcached_instance))
+    namespace_key = _namespace_key(namespace, ())
+
+    if mc.incr(namespace_key) is None:
+        mc.set(namespace_key, _new_generation())
+
+    _generation_cache.delete((memcached_instance, namespace_key))
+
+def _namespaces(namespace):
+    if namespace is None:
+        return ()
+    if isinstance(namespace, basestring):
+        return (namespace,)
+    return tuple(namespace)
+
+def _namespace_key(namespace, format_args):
+    return _format_key("ns:" + namespace, format_args)
+
+def _namespaced(key, namespace_keys, generations):
+    return "{0}#{1}".format(key, '.'.join(str(generations[n]) for n in namespace_keys))
+
+def _new_generation():
+    # start from the clock, so that a generation counter evicted from memcache
+    # doesn't restart at a number that older keys were written under.
+    return int(time.time() * 1000)
+
+def _generations(mc, memcached_instance, namespace_keys):
+    generations = dict()
+    missing = []
+
+    for namespace_key in namespace_keys:
+        generation = _generation_cache.get((memcached_instance, namespace_key))
+
+        if generation is None:
+            missing.append(namespace_key)
+        else:
+            generations[namespace_key] = generation
+
+    if missing:
+        found = mc.get_multi(missing)
+
+        for namespace_key in missing:
+            generation = found.get(namespace_key)
+
+            if generation is None:
+                generation = _new_generation()
+
+                if not mc.add(namespace_key, generation):
+                    generation = mc.get(namespace_key) or generation
+
+            generations[namespace_key] = generation
+            _generation_cache.set((memcached_instance, namespace_key), generation)
+
+    return generations
+
+# memcache can't distinguish a stored None from a miss, so None is cached as this.
+_NONE = "__shrapnel.caching.None__"
+
+def _to_cache(value, codec = None):
+    if codec is not None:
+        return codec.encode(value)
+    if value is None:
+        return _NONE
+    return value
+
+def _from_cache(value, codec = None):
+    if value is None:
+        return _MISSING
+    if codec is not None:
+        # anything the codec can't read (say, written before it was configured) is a miss.
+        try:
+            return codec.decode(value)
+        except CodecError:
+            return _MISSING
+    if isinstance(value, str) and value == _NONE:
+        return None
+    return value
+
+# values stored for early_refresh or revalidate_after are wrapped as (_ENVELOPE, value, stored_at, delta).
+_ENVELOPE = "__shrapnel.caching.Envelope__"
+
+def _envelope(value, stored_at, delta):
+    return (_ENVELOPE, value, stored_at, delta)
+
+def _unenvelope(entry):
+    # anything else was stored before enveloping was enabled; returns None for it.
+    if isinstance(entry, tuple) and len(entry) == 4 and entry[0] == _ENVELOPE:
+        return entry[1:]
+    return None
+
+def _expiry(value, expires, negative_expires):
+    if not value and negative_expires is not None:
+        return negative_expires
+    return expires
+
+
+class _Flight(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.succeeded = False
+        self.result = None
+
+
+_flights = dict()
+_flights_lock = threading.Lock()
+
+def _single_flight(flight_key, produce):
+    with _flights_lock:
+        flight = _flights.get(flight_key)
+        leader = flight is None
+
+        if leader:
+            flight = _flights[flight_key] = _Flight()
+
+    if not leader:
+        flight.event.wait()
+
+        if flight.succeeded:
+            return flight.result
+
+        # the leader failed, so take our own shot at it.
+        return produce()
+
+    try:
+        flight.result = produce()
+        flight.succeeded = True
+        return flight.result
+    finally:
+        with _flights_lock:
+            del _flights[flight_key]
+        flight.event.set()
+
+
+_revalidating = set()
+_revalidating_lock = threading.Lock()
+
+def _revalidate(flight_key, fill, callback = None):
+    from shrapnel.decorator import background_func
+
+    with _revalidating_lock:
+        if flight_key in _revalidating:
+            return
+        _revalidating.add(flight_key)
+
+    @background_func
+    def refresh():
+        try:
+            value = fill()
+
+            if callback:
+                callback(value)
+        finally:
+            with _revalidating_lock:
+                _revalidating.discard(flight_key)
+
+    # if the refresh can't be queued (say, the pool rejects it when full), the stale
+    # value is still served, and a later call tries again.
+    try:
+        refresh()
+    except Exception:
+        logging.warning("Could not start revalidating {0!r}.".format(flight_key), exc_info = True)
+
+        with _revalidating_lock:
+            _revalidating.discard(flight_key)
+
+
+LEASE_POLL_INTERVAL = 0.05
+
+def _leased(mc, key, produce, peek, lock_timeout, stale = _MISSING):
+    lock_key = "{0}:lock".format(key)
+
+    # memcache clients send expiries as whole seconds, and an expiry of 0 never expires.
+    if mc.add(lock_key, 1, int(math.ceil(lock_timeout))):
+        try:
+            return produce()
+        finally:
+            mc.delete(lock_key)
+
+    # python-memcached's add fails the same way when memcache is down, and then
+    # nobody holds the lease (or its holder has just finished), so don't wait.
+    if mc.get(lock_key) is None:
+        value = peek()
+        return produce() if value is _MISSING else value
+
+    # someone else holds the lease.  if we have a value that's merely due for an
+    # early refresh, serve it rather than waiting.
+    if stale is not _MISSING:
+        return stale
+
+    deadline = time.time() + lock_timeout
+
+    while time.time() < deadline:
+        time.sleep(LEASE_POLL_INTERVAL)
+        value = peek()
+
+        if value is not _MISSING:
+            return value
+
+    return produce()
+
+
+def _refresh_early(expires_at, delta, beta):
+    # "Optimal Probabilistic Cache Stampede Prevention", Vattani et al.
+    return time.time() - delta * beta * math.log(1.0 - random.random()) >= expires_at
+
+
+def _format_args_tuple(format_args):
+    if not isinstance(format_args, tuple):
+        format_args = (format_args,)
+    return format_args
+
+
+def _format_key(key_format, format_args):
+    key = key_format.format(*_format_args_tuple(format_args))
+
+    if isinstance(key, unicode):
+        key = key.encode('ascii')
+
+    return key
+
+
+class CacheStats(object):
+    """
+    Hit/miss counts, memcache get and set latencies, stored value sizes and
+    recompute times for one cached function.  Sizes are only known for values
+    stored as strings, which is all of them when a codec is used.
+    """
+    def __init__(self, name, key_format = None):
+        self.name = name
+        self.key_format = key_format
+        self.get_time = instrument.Histogram.latency()
+        self.set_time = instrument.Histogram.latency()
+        self.compute_time = instrument.Histogram.latency()
+        self.value_size = instrument.Histogram.size()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.hits = 0
+            self.local_hits = 0
+            self.misses = 0
+
+        for histogram in (self.get_time, self.set_time, self.compute_time, self.value_size):
+            histogram.reset()
+
+    def count(self, hit, local = False, n = 1):
+        with self._lock:
+            if local:
+                self.local_hits += n
+            elif hit:
+                self.hits += n
+            else:
+                self.misses += n
+
+    def get(self, mc, key):
+        started = time.time()
+        result = mc.get(key)
+        self.get_time.add(time.time() - started)
+        return result
+
+    def get_multi(self, mc, keys):
+        started = time.time()
+        result = mc.get_multi(keys)
+        self.get_time.add(time.time() - started)
+        return result
+
+    def set(self, mc, key, value, expires):
+        self.value_size_of(value)
+        started = time.time()
+        result = mc.set(key, value, expires)
+        self.set_time.add(time.time() - started)
+        return result
+
+    def set_multi(self, mc, mapping, expires):
+        for value in mapping.itervalues():
+            self.value_size_of(value)
+
+        started = time.time()
+        result = mc.set_multi(mapping, expires)
+        self.set_time.add(time.time() - started)
+        return result
+
+    def value_size_of(self, value):
+        if isinstance(value, str):
+            self.value_size.add(len(value))
+
+    @property
+    def hit_ratio(self):
+        lookups = self.hits + self.local_hits + self.misses
+        return float(self.hits + self.local_hits) / lookups if lookups else None
+
+    def snapshot(self):
+        return dict(
+            key_format = self.key_format,
+            hits = self.hits,
+            local_hits = self.local_hits,
+            misses = self.misses,
+            hit_ratio = self.hit_ratio,
+            get_time = self.get_time.snapshot(),
+            set_time = self.set_time.snapshot(),
+            compute_time = self.compute_time.snapshot(),
+            value_size = self.value_size.snapshot()
+        )
+
+
+_cache_stats = instrument.StatsRegistry(CacheStats)
+
+def cache_stats(reset = False):
+    """
+    Returns a snapshot of every cached function's CacheStats, by function name
+    (qualified with its class, for methods).
+    """
+    return _cache_stats.snapshot(reset)
+
+def start_cache_stats_dump(interval = 60):
+    """
+    Appends cache_stats() to cachestats-<pid>.log every 'interval' seconds.
+    """
+    thread = instrument.StatsDumpThread(functools.partial(cache_stats, reset = True), 'cachestats', interval)
+    thread.start()
+    return thread
+
+def _register_stats(undecorated, frame, key_format = None):
+    return _cache_stats.register(instrument.qualified_name(undecorated, frame), key_format)
+
+
+class CodecError(ValueError):
+    pass
+
+
+class PickleSerializer(object):
+    id = 0
+
+    def dumps(self, value):
+        return cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data):
+        return cPickle.loads(data)
+
+
+class MarshalSerializer(object):
+    """
+    Much faster than pickle for values built from builtin types, but can't handle
+    instances of user-defined classes.
+    """
+    id = 1
+
+    def dumps(self, value):
+        return marshal.dumps(value)
+
+    def loads(self, data):
+        return marshal.loads(data)
+
+
+_serializers = dict()
+
+def register_serializer(serializer):
+    """
+    Makes 'serializer' (an object with an integer 'id' from 0 to 7, and dumps and
+    loads methods) available for decoding, whichever Codec wrote the value.
+    """
+    if not 0 <= serializer.id <= 7:
+        raise ValueError("Serializer ids must be between 0 and 7.")
+    _serializers[serializer.id] = serializer
+    return serializer
+
+register_serializer(PickleSerializer())
+register_serializer(MarshalSerializer())
+
+
+class Codec(object):
+    """
+    Encodes values for the caching decorators as a string with a one byte header,
+    holding a format version, the serializer's id, and whether the payload is
+    zlib-compressed.  Payloads of at least 'compress_threshold' bytes are
+    compressed.  Decoding reads the header, so values written with any registered
+    serializer can be read back regardless of the codec's own serializer.
+    """
+    VERSION = 1
+
+    def __init__(self, serializer = None, compress_threshold = None, compress_level = 1):
+        self.serializer = serializer or _serializers[PickleSerializer.id]
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+
+    def encode(self, value):
+        data = self.serializer.dumps(value)
+        compressed = 0
+
+        if self.compress_threshold is not None and len(data) >= self.compress_threshold:
+            zipped = zlib.compress(data, self.compress_level)
+
+            if len(zipped) < len(data):
+                data = zipped
+                compressed = 1
+
+        return chr((self.VERSION << 4) | (self.serializer.id << 1) | compressed) + data
+
+    def decode(self, data):
+        if not isinstance(data, str) or not data:
+            raise CodecError("Not an encoded value.")
+
+        header = ord(data[0])
+
+        if header >> 4 != self.VERSION:
+            raise CodecError("Unknown codec version {0}.".format(header >> 4))
+
+        try:
+            serializer = _serializers[(header >> 1) & 7]
+        except KeyError:
+            raise CodecError("Unknown serializer {0}.".format((header >> 1) & 7))
+
+        data = data[1:]
+
+        try:
+            if header & 1:
+                data = zlib.decompress(data)
+
+            return serializer.loads(data)
+        except Exception, e:
+            raise CodecError(str(e))
+
+
+class LocalCache(object):
+    """
+    A bounded, in-process LRU cache with a per-entry time-to-live.  Intended
+    to sit in front of memcache (see the 'local_cache' argument to cached2) so
+    that hot keys don't cost a network round trip on every read.
+    """
+    def __init__(self, max_size = 1000, ttl = 5):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default = None):
+        now = time.time()
+
+        with self._lock:
+            try:
+                value, expires = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires and expires <= now:
+                self.misses += 1
+                return default
+
+            self._entries[key] = (value, expires)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl = None):
+        if ttl is None:
+            ttl = self.ttl
+
+        expires = time.time() + ttl if ttl else 0
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last = False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def stats(self):
+        return dict(
+            hits = self.hits,
+            misses = self.misses,
+            evictions = self.evictions,
+            size = len(self._entries)
+        )
+
+
+STAT_INTERVAL = 2.0
+
+_mtimes = dict()
+_mtimes_lock = threading.Lock()
+
+def _mtime(path, interval):
+    """
+    os.stat(path).st_mtime, re-stat-ing a given path at most once every
+    'interval' seconds per process.
+    """
+    now = time.time()
+    cached = _mtimes.get(path)
+
+    if cached and now - cached[1] < interval:
+        return cached[0]
+
+    mtime = os.stat(path).st_mtime
+
+    with _mtimes_lock:
+        _mtimes[path] = (mtime, now)
+
+    return mtime
+
+
+_digests = LocalCache(max_size = 1000, ttl = 0)
+_generation_cache = LocalCache(max_size = 10000, ttl = NAMESPACE_TTL)
+
 
 class CacheKeyGenerator(object):
     def __init__(self, *key_parts, **kwargs):
         self._do_stat = kwargs.pop('do_stat', False)
-        self._file_names = []
+        self._stat_interval = kwargs.pop('stat_interval', STAT_INTERVAL)
         self._file_parts = []
         self._key_parts = key_parts
         self._key = None
@@ -120,20 +999,30 @@ class CacheKeyGenerator(object):
 
         for f in files:
             if self._do_stat:
-                mtime = os.stat(f).st_mtime
+                mtime = _mtime(f, self._stat_interval)
 
-            index = bisect.bisect(self._file_names, f)
-            self._file_names.insert(index, f)
-            self._file_parts.insert(index + 1, "{0}:{1}".format(f, mtime))
+            self._file_parts.append((f, "{0}:{1}".format(f, mtime)))
 
     @property
     def key(self):
         if not self._key:
-            parts = itertools.chain(self._key_parts, self._file_parts)
-            parts = (str(part) for part in parts)
-            self._key = security.hash(':'.join(parts))
+            self._file_parts.sort()
+            parts = tuple(str(part) for part in itertools.chain(self._key_parts, (p for (f, p) in self._file_parts)))
+            self._key = _digests.get(parts)
+
+            if not self._key:
+                digest = security.hasher()
+
+                for i, part in enumerate(parts):
+                    if i:
+                        digest.update(':')
+                    digest.update(part)
+
+                self._key = security.webencode(digest.digest())
+
+                if isinstance(self._key, unicode):
+                    self._key = self._key.encode('ascii')
 
-            if isinstance(self._key, unicode):
-                self._key = self._key.encode('ascii')
+                _digests.set(parts, self._key)
 
-        return self._key
\ No newline at end of file
+        return self._key
@@ -7,9 +7,11 @@ Created by Kurtiss Hare on 2010-05-05.
 Copyright (c) 2010 Medium Entertainment, Inc. All rights reserved.
 """
 
-import threading, multiprocessing, sys, atexit, copy
+import threading, multiprocessing, sys, atexit, copy, logging, os, time, Queue
+import mmap, tempfile
 
-from shrapnel.decorator import nonimmediate
+from shrapnel.decorator import nonimmediate, ioloop_callback
+from shrapnel import instrument
 
 # http://stackoverflow.com/questions/2173206/is-there-any-way-to-create-a-class-property-in-python
 class classprop(object):
@@ -19,6 +21,107 @@ class classprop(object):
     return self.f.__get__(*a)()
 
 
+class PoolFullError(RuntimeError):
+    pass
+
+
+class ThreadPool(object):
+    """
+    A bounded pool of daemon worker threads.  At most 'max_queue' tasks (0 for no
+    limit) wait for a worker; when the queue is full, 'policy' decides what
+    happens to a new task: BLOCK waits for room, REJECT raises PoolFullError, and
+    CALLER_RUNS runs it on the submitting thread.  Workers are started lazily, and
+    restarted in a child process after a fork.
+    """
+    BLOCK = 'block'
+    REJECT = 'reject'
+    CALLER_RUNS = 'caller_runs'
+
+    def __init__(self, size = 32, max_queue = 0, policy = BLOCK):
+        if policy not in (self.BLOCK, self.REJECT, self.CALLER_RUNS):
+            raise ValueError("Unknown ThreadPool policy: {0}".format(policy))
+
+        self.size = size
+        self.max_queue = max_queue
+        self.policy = policy
+        self.queue_wait = instrument.Histogram.latency()
+        self.run_time = instrument.Histogram.latency()
+        self.rejected = 0
+        self.active = 0
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def submit(self, target, *args, **kwargs):
+        self._ensure_workers()
+        task = (time.time(), target, args, kwargs)
+
+        if self.policy == self.BLOCK:
+            self._queue.put(task)
+            return
+
+        try:
+            self._queue.put_nowait(task)
+        except Queue.Full:
+            with self._lock:
+                self.rejected += 1
+
+            if self.policy == self.REJECT:
+                raise PoolFullError("ThreadPool queue is full ({0} tasks).".format(self.max_queue))
+
+            target(*args, **kwargs)
+
+    @property
+    def queued(self):
+        return self._queue.qsize() if self._pid else 0
+
+    def stats(self):
+        return dict(
+            size = self.size,
+            active = self.active,
+            queued = self.queued,
+            rejected = self.rejected,
+            queue_wait = self.queue_wait.snapshot(),
+            run_time = self.run_time.snapshot()
+        )
+
+    def _ensure_workers(self):
+        pid = os.getpid()
+
+        if self._pid == pid:
+            return
+
+        with self._lock:
+            if self._pid != pid:
+                self._queue = Queue.Queue(self.max_queue)
+                self.active = 0
+
+                for i in xrange(self.size):
+                    worker = threading.Thread(target = self._work, args = (self._queue,))
+                    worker.daemon = True
+                    worker.start()
+
+                self._pid = pid
+
+    def _work(self, queue):
+        while True:
+            queued_at, target, args, kwargs = queue.get()
+            started = time.time()
+            self.queue_wait.add(started - queued_at)
+
+            with self._lock:
+                self.active += 1
+
+            try:
+                target(*args, **kwargs)
+            except Exception:
+                logging.exception("Uncaught exception in ThreadPool task.")
+            finally:
+                with self._lock:
+                    self.active -= 1
+
+                self.run_time.add(time.time() - started)
+
+
 class UserFunction(object):
     def __new__(cls, *args, **kwargs):
         instance = super(UserFunction, cls).__new__(cls)
@@ -54,20 +157,174 @@ def run_background_func(cls, args, kwargs):
         import traceback
         traceback.print_exc()
 
+def run_background_func_for_future(cls, args, kwargs):
+    """
+    Like run_background_func, but reports failure as a formatted traceback, since
+    the exception itself may not survive pickling.
+    """
+    try:
+        instance = cls(run=False, *args, **kwargs)
+        return instance.execute(), None
+    except Exception:
+        import traceback
+        return None, traceback.format_exc()
+
+class ProcessFunctionError(RuntimeError):
+    pass
+
+def run_indexed_background_func(call):
+    index, cls, args, kwargs = call
+    return index, run_background_func(cls, args, kwargs)
+
+
+class SharedBuffer(object):
+    """
+    A fixed-size block of memory shared with ProcessFunction workers without
+    being copied through pickle: only its path and size are pickled, and each
+    process maps the same file (in /dev/shm where available).  'mmap' supports
+    slicing, buffer() and in-place writes from either side.  The creating process
+    must close() it once the workers are done with it.
+    """
+    def __init__(self, size):
+        directory = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        fd, self.path = tempfile.mkstemp(prefix = 'shrapnel-', dir = directory)
+
+        try:
+            os.ftruncate(fd, size)
+            self.size = size
+            self._mmap = mmap.mmap(fd, size) if size else None
+        finally:
+            os.close(fd)
+
+        self._owner = True
+
+    @classmethod
+    def from_bytes(cls, data):
+        shared = cls(len(data))
+
+        if data:
+            shared.mmap[:] = data
+
+        return shared
+
+    @property
+    def mmap(self):
+        if self._mmap is None and self.size:
+            fd = os.open(self.path, os.O_RDWR)
+
+            try:
+                self._mmap = mmap.mmap(fd, self.size)
+            finally:
+                os.close(fd)
+
+        return self._mmap
+
+    def __getstate__(self):
+        return dict(path = self.path, size = self.size)
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self.size = state['size']
+        self._mmap = None
+        self._owner = False
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+        if self._owner:
+            self._owner = False
+
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+
 class ProcessFunction(UserFunction):
-    _procpool = None
+    """
+    'delay' runs 'execute' in a multiprocessing.Pool.  Subclasses share the
+    'default' pool unless they set 'procpool_name', so that slow jobs can be kept
+    from starving fast ones.  Pools are sized with configure_procpool, and
+    default to one process per core, shared out between the server processes
+    set with share_cores.
+    """
+    procpool_name = 'default'
+    _procpools = dict()
+    _procpool_settings = dict()
+    _procpool_sharers = 1
+    _procpools_lock = threading.Lock()
+
     def __init__(self, callback=None, **kwargs):
         self.callback = callback
         UserFunction.__init__(self, **kwargs)
 
+    @classmethod
+    def configure_procpool(cls, name = 'default', processes = None, maxtasksperchild = None):
+        """
+        Sets the size of the named pool (None for the core count) and how many
+        tasks each of its workers runs before being replaced (None for no limit).
+        Takes effect when the pool is next created.
+        """
+        with ProcessFunction._procpools_lock:
+            ProcessFunction._procpool_settings[name] = dict(
+                processes = processes,
+                maxtasksperchild = maxtasksperchild
+            )
+
+    @classmethod
+    def share_cores(cls, processes):
+        """
+        Divides the cores between 'processes' forked processes that each create
+        their own pools, for pools without a configured size.
+        """
+        with ProcessFunction._procpools_lock:
+            ProcessFunction._procpool_sharers = max(1, processes)
+
+    @classmethod
+    def get_procpool(cls, name = 'default'):
+        pid = os.getpid()
+
+        with ProcessFunction._procpools_lock:
+            pool_pid, pool = ProcessFunction._procpools.get(name, (None, None))
+
+            # a pool inherited over a fork belongs to the parent.
+            if pool_pid != pid:
+                settings = ProcessFunction._procpool_settings.get(name, dict())
+                pool = multiprocessing.Pool(
+                    settings.get('processes') or max(1, multiprocessing.cpu_count() // ProcessFunction._procpool_sharers),
+                    initializer = instrument.reset_profiler_toggle,
+                    maxtasksperchild = settings.get('maxtasksperchild')
+                )
+                ProcessFunction._procpools[name] = (pid, pool)
+
+            return pool
+
+    @classmethod
+    def close_procpools(cls):
+        for pool in ProcessFunction._own_procpools():
+            pool.close()
+
+    @classmethod
+    def terminate_procpools(cls):
+        for pool in ProcessFunction._own_procpools():
+            pool.terminate()
+            pool.join()
+
+        with ProcessFunction._procpools_lock:
+            ProcessFunction._procpools.clear()
+
+    @classmethod
+    def _own_procpools(cls):
+        pid = os.getpid()
+
+        with ProcessFunction._procpools_lock:
+            return [pool for (pool_pid, pool) in ProcessFunction._procpools.values() if pool_pid == pid]
+
     @classprop
     def procpool(cls):
-        if not cls._procpool:
-            cls._procpool = multiprocessing.Pool(3)
-            def onclose():
-                cls._procpool.close()
-            atexit.register(onclose)
-        return cls._procpool
+        return cls.get_procpool(cls.procpool_name)
 
     @classmethod
     def delay(cls, *args, **kwargs):
@@ -77,11 +334,67 @@ class ProcessFunction(UserFunction):
         if callback:
             result = cls.procpool.apply_async(run_background_func,
                                               args=[cls, args, kwargs], 
-                                              callback=callback)
+                                              callback=ioloop_callback(callback))
         else:
             result = cls.procpool.apply_async(run_background_func, [cls, args, kwargs])
         return result
 
+    @classmethod
+    def delay_future(cls, *args, **kwargs):
+        """
+        Like delay, but returns a shrapnel.web.Future for the result.  A failure
+        in the worker resolves it with a ProcessFunctionError carrying the worker's
+        traceback.
+        """
+        import web
+        future = web.Future()
+
+        def on_result(outcome):
+            result, error = outcome
+
+            if error:
+                future.set_exception(ProcessFunctionError(error))
+            else:
+                future.set_result(result)
+
+        sys.stderr.flush()
+        sys.stdout.flush()
+        cls.procpool.apply_async(run_background_func_for_future, [cls, args, kwargs], callback = on_result)
+        return future
+
+    @classmethod
+    def delay_many(cls, arglist, callback = None, done_callback = None, chunksize = 16, **kwargs):
+        """
+        Runs 'execute' in the pool once per entry of 'arglist' (a tuple of positional
+        arguments, or a single argument), with 'kwargs' common to every call.  Calls
+        are sent to workers 'chunksize' at a time, and their results stream back as
+        they complete, in no particular order.  With a 'callback', each result is
+        passed to callback(index, result) on the IOLoop, followed by a call to
+        done_callback(); otherwise, an iterator of (index, result) pairs is returned.
+        Use SharedBuffer for large payloads.
+        """
+        sys.stderr.flush()
+        sys.stdout.flush()
+
+        calls = ((index, cls, _args_tuple(args), kwargs) for (index, args) in enumerate(arglist))
+        results = cls.procpool.imap_unordered(run_indexed_background_func, calls, chunksize)
+
+        if not callback:
+            return results
+
+        callback = ioloop_callback(callback)
+
+        def stream():
+            for index, result in results:
+                callback(index, result)
+
+            if done_callback:
+                ioloop_callback(done_callback)()
+
+        streamer = threading.Thread(target = stream)
+        streamer.daemon = True
+        streamer.start()
+
     @property
     def target(self):
         if getattr(self, 'callback', None):
@@ -91,16 +404,47 @@ class ProcessFunction(UserFunction):
             return self.execute
 
     def __call__(self):
-        return threading.Thread(target = self.target).start()
+        BackgroundFunction.threadpool.submit(self.target)
 
     def execute(self):
         pass
 
+atexit.register(ProcessFunction.close_procpools)
+
+def _args_tuple(args):
+    if not isinstance(args, tuple):
+        args = (args,)
+    return args
+
+
 class BackgroundFunction(UserFunction):
+    """
+    Runs 'execute' on a worker from 'threadpool', a ThreadPool shared by all
+    subclasses unless one sets its own.
+    """
+    threadpool = ThreadPool()
+
+    @classmethod
+    def configure_threadpool(cls, **kwargs):
+        cls.threadpool = ThreadPool(**kwargs)
+        return cls.threadpool
+
     def __init__(self, callback = None):
         super(BackgroundFunction, self).__init__()
         self.callback = callback
 
+    @classmethod
+    def future(cls, *args, **kwargs):
+        """
+        Runs the function, returning a shrapnel.web.Future for its result.  The
+        subclass must accept a 'callback' keyword argument, as BackgroundFunction
+        does.
+        """
+        import web
+        future = web.Future()
+        cls(callback = future.resolve, *args, **kwargs)
+        return future
+
     def __call__(self):
         if self.callback:
             import web
@@ -108,7 +452,7 @@ class BackgroundFunction(UserFunction):
         else:
             target = self.execute
 
-        threading.Thread(target = target).start()
+        self.threadpool.submit(target)
 
     def execute(self):
         pass
@@ -7,11 +7,17 @@ Created by Kurtiss Hare on 2010-02-10.
 Copyright (c) 2010 Medium Entertainment, Inc. All rights reserved.
 """
 
+import errno
+import fcntl
 import logging
 import logging.handlers
 import optparse
 import os
+import random
+import select
 import signal
+import socket
+import subprocess
 import sys
 import time
 import tornado.httpserver
@@ -19,26 +25,54 @@ import tornado.ioloop
 from tornado.options import options as tornado_options
 import tornado.web
 import shrapnel.classtools
+import shrapnel.web
+
+
+# set in a replacement process to the listening socket it inherits, the pid of the process it replaces,
+# and the pipe on which it reports that it's serving.
+_LISTEN_FD_VARIABLE = 'SHRAPNEL_LISTEN_FD'
+_REPLACING_VARIABLE = 'SHRAPNEL_REPLACING'
+_READY_FD_VARIABLE = 'SHRAPNEL_READY_FD'
 
 
 class ShrapnelApplication(object):
+    # a worker that exits sooner than this after being spawned is respawned after a delay of this long.
+    respawn_delay = 1.0
+    # how long a stopping process waits for its in-flight requests to finish.
+    drain_timeout = 10000
+    # how long a reloading process waits for its replacement to start serving before giving up on it.
+    reload_timeout = 60
+
     def get_tornado_server(self, application):
         return tornado.httpserver.HTTPServer(application)
         
     def get_tornado_application(self):
         return tornado.web.Application([])
+
+    def get_request_tracker(self, application):
+        return shrapnel.web.RequestTracker(application)
         
     def __init__(self, path, version = '', command = None):
         self.autoreload = False
         self.path = path
         self.version = version
         self.command = command or self.serve
+        self.worker_index = None
+        self._ready_fd = None
+        self._pidfile = None
+        self._reloading = False
 
     @property
     def _tornado_server(self):
         if not hasattr(self, '_tornado_server_instance'):
-            self._tornado_server_instance = self.get_tornado_server(self._tornado_application)
+            self._tornado_server_instance = self.get_tornado_server(self._request_tracker)
         return self._tornado_server_instance
+
+    @property
+    def _request_tracker(self):
+        if not hasattr(self, '_request_tracker_instance'):
+            self._request_tracker_instance = self.get_request_tracker(self._tornado_application)
+        return self._request_tracker_instance
     
     @property
     def _tornado_application(self):
@@ -85,6 +119,22 @@ class ShrapnelApplication(object):
             help    = "The path to a file which will contain the server's informational log messages."
         )       
 
+        parser.add_option("-n", "--processes",
+            action  = "store",
+            dest    = "processes",
+            type    = "int",
+            default = 1,
+            help    = "The number of worker processes to fork, all serving the same port (0 for one per core)."
+        )
+
+        parser.add_option("-d", "--drain-timeout",
+            action  = "store",
+            dest    = "drain_timeout",
+            type    = "float",
+            default = None,
+            help    = "The number of seconds a stopping or reloading server waits for in-flight requests to finish."
+        )
+
         options, args = parser.parse_args()
 
         # tornado.locale.load_translations(
@@ -115,8 +165,12 @@ class ShrapnelApplication(object):
             f = open(options.pidfile, "r")
             f.seek(0)
             old_pid = f.readline()
+            # closed now, since its descriptor is about to be closed and reused.
+            f.close()
             
-            if os.path.exists("/proc/{0}".format(old_pid)):
+            if old_pid == os.environ.get(_REPLACING_VARIABLE):
+                print "Replacing process {0} after a reload.".format(old_pid)
+            elif os.path.exists("/proc/{0}".format(old_pid)):
                 print "Old PID file exists, and process is still running: {0}".format(options.pidfile)
                 sys.exit(1)
             else:
@@ -128,7 +182,12 @@ class ShrapnelApplication(object):
         if (maxfd == resource.RLIM_INFINITY):
             maxfd = 1024
 
+        inherited_fds = (os.environ.get(_LISTEN_FD_VARIABLE), os.environ.get(_READY_FD_VARIABLE))
+
         for fd in range(3, maxfd):
+            if str(fd) in inherited_fds:
+                continue
+
             try:
                 os.close(fd)
             except  OSError:
@@ -149,7 +208,14 @@ class ShrapnelApplication(object):
         else:
             sys.stderr = _NullDescriptor()  
 
-        f = open(options.pidfile, "w")
+        self._pidfile = options.pidfile
+
+        # a replacement takes the pidfile over once it's serving (see _report_ready).
+        if not os.environ.get(_REPLACING_VARIABLE):
+            self._write_pidfile()
+
+    def _write_pidfile(self):
+        f = open(self._pidfile, "w")
         f.write("{0}".format(os.getpid()))
         f.close()
 
@@ -159,15 +225,49 @@ class ShrapnelApplication(object):
         elif options.infolog or options.errorlog:
             _setup_logging(options)
 
+        processes = getattr(options, 'processes', 1)
+
+        if getattr(options, 'drain_timeout', None) is not None:
+            self.drain_timeout = options.drain_timeout
+
+        inherited = self._inherit_socket()
+
+        if processes is not None and processes <= 0:
+            import multiprocessing
+            processes = multiprocessing.cpu_count()
+
+        if processes > 1 and self.autoreload:
+            logging.error("Autoreload can't be used with multiple processes; running a single process.")
+            processes = 1
+
+        if processes > 1:
+            if not inherited:
+                self._tornado_server.bind(int(options.port))
+
+            # each worker creates its own pools below.
+            shrapnel.classtools.ProcessFunction.share_cores(processes)
+
+            # only returns in the forked workers.
+            self._supervise(processes)
+            self._start_worker()
+
         signal.signal(signal.SIGINT, self.graceful_stop)
         signal.signal(signal.SIGTERM, self.graceful_stop)
+        # with multiple processes, the supervisor handles reloads.
+        signal.signal(signal.SIGHUP, self.reload if processes <= 1 else signal.SIG_IGN)
 
         # TODO: can't wait to get rid of this
         self._pid = os.getpid()
         shrapnel.classtools.ProcessFunction.procpool
 
         if self._pid == os.getpid():
-            self._tornado_server.listen(int(options.port))
+            if processes <= 1:
+                if inherited:
+                    self._tornado_server.start(1)
+                else:
+                    self._tornado_server.listen(int(options.port))
+
+                self._report_ready()
 
             if (self.autoreload):
                 import tornado.autoreload
@@ -178,14 +278,270 @@ class ShrapnelApplication(object):
                 self.graceful_stop()
             except KeyboardInterrupt, e:
                 self.graceful_stop()
+
+    def _supervise(self, processes):
+        """
+        Forks 'processes' workers, which return to serve on the already-bound socket,
+        and respawns any that exit until the supervisor is told to stop, at which
+        point it passes the signal on and exits once every worker has.
+        """
+        # the workers would share its epoll descriptor, and anything that captured
+        # it would keep using it after the fork, so it has to wait for the workers.
+        if tornado.ioloop.IOLoop.initialized():
+            raise RuntimeError("An IOLoop was created before the workers were forked.  Create it, and anything that holds on to it (such as an asyncmemcache.Client), once each worker has started.")
+
+        self._workers = dict()
+        self._stopping = False
+
+        signal.signal(signal.SIGINT, self._stop_workers)
+        signal.signal(signal.SIGTERM, self._stop_workers)
+        signal.signal(signal.SIGHUP, self._reload_workers)
+
+        for index in xrange(processes):
+            if not self._spawn_worker(index):
+                return
+
+        self._report_ready()
+
+        while self._workers:
+            try:
+                pid, status = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+
+            if pid not in self._workers:
+                continue
+
+            index, started = self._workers.pop(pid)
+
+            if self._stopping:
+                continue
+
+            logging.error("Worker {0} (pid {1}) exited with status {2}; respawning.".format(index, pid, status))
+
+            if time.time() - started < self.respawn_delay:
+                time.sleep(self.respawn_delay)
+
+            if not self._spawn_worker(index):
+                return
+
+        sys.exit(0)
+
+    def _spawn_worker(self, index):
+        pid = os.fork()
+
+        if pid == 0:
+            self.worker_index = index
+            self._workers = dict()
+
+            # only the supervisor reports that it's serving.
+            if self._ready_fd is not None:
+                os.close(self._ready_fd)
+                self._ready_fd = None
+
+            return False
+
+        self._workers[pid] = (index, time.time())
+        return True
+
+    def _stop_workers(self, *args, **kwargs):
+        self._stopping = True
+
+        for pid in self._workers.keys():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def _reload_workers(self, *args, **kwargs):
+        if self._reloading:
+            return
+
+        self._reloading = True
+        process, ready = self._spawn_replacement()
+        deadline = time.time() + self.reload_timeout
+        serving = None
+
+        while serving is None and _wait_readable(ready, deadline - time.time()):
+            serving = self._read_replacement(ready)
+
+        if serving:
+            self._stop_workers()
+        else:
+            self._replacement_failed(process, ready)
+
+    def reload(self, *args, **kwargs):
+        """
+        Starts a replacement process, running the current code, on this process's
+        listening socket, and once it reports that it's serving, stops this one
+        gracefully.  Connections made in the meantime wait in the socket's backlog,
+        so none are refused.  If the replacement exits, or isn't serving within
+        'reload_timeout' seconds, this process carries on serving.
+        """
+        if os.getpid() != self._pid or self._reloading:
+            return
+
+        self._reloading = True
+        io_loop = self._tornado_server.io_loop
+        process, ready = self._spawn_replacement()
+
+        def on_ready(fd, events):
+            serving = self._read_replacement(ready)
+
+            if serving is None:
+                return
+
+            io_loop.remove_handler(ready)
+            io_loop.remove_timeout(timeout)
+
+            if serving:
+                self.graceful_stop()
+            else:
+                self._replacement_failed(process, ready)
+
+        def on_timeout():
+            io_loop.remove_handler(ready)
+            self._replacement_failed(process, ready)
+
+        io_loop.add_handler(ready, on_ready, io_loop.READ)
+        timeout = io_loop.add_timeout(time.time() + self.reload_timeout, on_timeout)
+
+    def _spawn_replacement(self):
+        """
+        Starts the replacement process, and returns it along with the read end of
+        the pipe on which it will report its pid, and then that it's serving.  It
+        inherits only the listening socket and that pipe.
+        """
+        fd = self._tornado_server._socket.fileno()
+        flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+        fcntl.fcntl(fd, fcntl.F_SETFD, flags & ~fcntl.FD_CLOEXEC)
+        ready, ready_write = os.pipe()
+        fcntl.fcntl(ready, fcntl.F_SETFD, fcntl.fcntl(ready, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        self._replacement_pid = None
+        self._replacement_report = ''
+
+        try:
+            environment = dict(os.environ)
+            environment[_LISTEN_FD_VARIABLE] = str(fd)
+            environment[_REPLACING_VARIABLE] = str(os.getpid())
+            environment[_READY_FD_VARIABLE] = str(ready_write)
+            process = subprocess.Popen([sys.executable] + sys.argv, env = environment,
+                preexec_fn = lambda: _close_inherited_fds(fd, ready_write))
+        finally:
+            fcntl.fcntl(fd, fcntl.F_SETFD, flags)
+            # once the replacement's copy closes too, the pipe reads as empty.
+            os.close(ready_write)
+
+        return process, ready
+
+    def _read_replacement(self, ready):
+        """
+        Reads the lines the replacement has reported: "pid <pid>" once it has
+        daemonized, and then "ready".  Returns True once it's serving, False if it
+        closed the pipe (by exiting) first, and None while it's still starting.
+        """
+        try:
+            data = os.read(ready, 64)
+        except OSError:
+            return False
+
+        if not data:
+            return False
+
+        self._replacement_report += data
+
+        while '\n' in self._replacement_report:
+            line, self._replacement_report = self._replacement_report.split('\n', 1)
+
+            if line.startswith('pid '):
+                self._replacement_pid = int(line[4:])
+            elif line == 'ready':
+                return True
+
+        return None
+
+    def _replacement_failed(self, process, ready):
+        os.close(ready)
+        logging.error("The replacement process didn't start serving; carrying on with this one.")
+
+        if process.poll() is None:
+            process.terminate()
+            process.wait()
+
+        # a daemonized replacement's first fork has already exited, leaving the daemon behind.
+        if self._replacement_pid not in (None, process.pid):
+            try:
+                os.kill(self._replacement_pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+        if self._pidfile:
+            self._write_pidfile()
+
+        self._reloading = False
+
+    def _report_ready(self):
+        if self._ready_fd is None:
+            return
+
+        fd, self._ready_fd = self._ready_fd, None
+
+        if self._pidfile:
+            self._write_pidfile()
+
+        try:
+            os.write(fd, "ready\n")
+        except OSError:
+            logging.error("Could not report that the server is ready; the process it replaces gave up on it.")
+        finally:
+            os.close(fd)
+
+    def _inherit_socket(self):
+        fd = os.environ.pop(_LISTEN_FD_VARIABLE, None)
+        os.environ.pop(_REPLACING_VARIABLE, None)
+        ready_fd = os.environ.pop(_READY_FD_VARIABLE, None)
+
+        if ready_fd is not None:
+            self._ready_fd = int(ready_fd)
+            fcntl.fcntl(self._ready_fd, fcntl.F_SETFD, fcntl.fcntl(self._ready_fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+            # so that the process being replaced can stop this one, rather than its
+            # first fork, if it gives up on it.
+            try:
+                os.write(self._ready_fd, "pid {0}\n".format(os.getpid()))
+            except OSError:
+                pass
+
+        if fd is None:
+            return False
+
+        fd = int(fd)
+        sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+        os.close(fd)
+
+        flags = fcntl.fcntl(sock.fileno(), fcntl.F_GETFD)
+        fcntl.fcntl(sock.fileno(), fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+        sock.setblocking(0)
+        self._tornado_server._socket = sock
+        return True
+
+    def _start_worker(self):
+        random.seed()
+        self._tornado_server.io_loop = None
+        self._tornado_server.start(1)
             
     def serve(self):
         self._tornado_server.io_loop.start()
         
     def graceful_stop(self, *args, **kwargs):
-        if os.getpid() == self._pid:
+        if os.getpid() == self._pid and not getattr(self, '_draining', False):
+            self._draining = True
             self._tornado_server.stop()
-            shrapnel.classtools.ProcessFunction.procpool.close()
+            shrapnel.classtools.ProcessFunction.close_procpools()
             io_loop = self._tornado_server.io_loop
 
             if io_loop.running():
@@ -198,7 +554,7 @@ class ShrapnelApplication(object):
                 check_graceful_stop.start()
 
                 io_loop.add_timeout(
-                    time.time() + 10000, 
+                    time.time() + self.drain_timeout, 
                     self._graceful_stop_now
                 )
             else:
@@ -206,19 +562,52 @@ class ShrapnelApplication(object):
     
     def _graceful_stop_now(self):
         self._tornado_server.io_loop.stop()
-        shrapnel.classtools.ProcessFunction.procpool.terminate()
-        shrapnel.classtools.ProcessFunction.procpool.join()
+        shrapnel.classtools.ProcessFunction.terminate_procpools()
         self.stop()
         sys.exit(0)
 
     def _poll_graceful_stop(self):
-        if len(self._tornado_server.io_loop._handlers) == 1:
+        if not self._request_tracker.in_flight and not self._request_tracker.background_jobs:
             self._graceful_stop_now()
     
     def stop(self):
         pass
 
 
+def _close_inherited_fds(*keep):
+    # runs in a replacement before it execs.  descriptors marked close-on-exec,
+    # subprocess's own error pipe among them, are left to the exec.
+    import resource
+
+    maxfd = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+    if maxfd == resource.RLIM_INFINITY:
+        maxfd = 1024
+
+    for fd in xrange(3, maxfd):
+        if fd in keep:
+            continue
+
+        try:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+        except IOError:
+            continue
+
+        if not flags & fcntl.FD_CLOEXEC:
+            os.close(fd)
+
+
+def _wait_readable(fd, timeout):
+    deadline = time.time() + timeout
+
+    while True:
+        try:
+            return bool(select.select([fd], [], [], max(0, deadline - time.time()))[0])
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+
+
 def _setup_logging(options):
     class _InfoFilter(logging.Filter):
         def filter(self, record):
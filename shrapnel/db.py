@@ -8,11 +8,30 @@ Copyright (c) 2010 Medium Entertainment, Inc. All rights reserved.
 """
 
 import functools
+import logging
+import random
+import re
+import sys
+import threading
+import time
 import types
+from shrapnel import instrument
 
 
-def transaction(retries=1):
+def transaction(retries=1, retryable=None, backoff=0.01, max_backoff=1.0):
+    """
+    Runs the decorated generator's work in a transaction, making up to 'retries'
+    attempts.  Only errors that 'retryable' (is_retryable by default) accepts
+    are retried, after sleeping for a random time of up to 'backoff' seconds,
+    doubling with each attempt to at most 'max_backoff'.  A transaction on a
+    ConnectionPool nested in another on the same pool joins it (see
+    ConnectionPool).
+    """
+    retryable = retryable or is_retryable
+
     def decorator(undecorated):
+        stats = _register_stats(undecorated, sys._getframe(1))
+
         @functools.wraps(undecorated)
         def decorated(*args, **kwargs):
             generator = undecorated(*args, **kwargs)
@@ -28,37 +47,486 @@ def transaction(retries=1):
             if not hasattr(db, 'execute') or not callable(db.execute):
                 raise RuntimeError('bad type for "db"')
 
+            pool = db if isinstance(db, ConnectionPool) else None
+
+            # the outer transaction begins, commits, and retries the whole of its work.
+            if pool is not None and pool._bound() is not None:
+                try:
+                    return generator.next()
+                except StopIteration:
+                    raise RuntimeError("{0.__name__} does not conform to the 'transaction' protocol.  It must return a generator of sufficient length.".format(undecorated))
+
             exception = None
             result = None
             for i in range(retries):
-                db.execute('begin')
+                if i:
+                    stats.count('retries')
+                    time.sleep(random.uniform(0, min(max_backoff, backoff * 2 ** (i - 1))))
+
+                stats.count('attempts')
+
+                if pool is not None:
+                    db = pool.checkout()
+                    pool._bind(db)
+
+                broken = False
                 try:
+                    db.execute('begin')
                     try:
                         result = generator.next()
                     except StopIteration:
+                        db.execute('rollback')
                         exception = RuntimeError("{0.__name__} does not conform to the 'transaction' protocol.  It must return a generator of sufficient length.".format(undecorated))
                         break
+                    except Exception as e:
+                        exc_info = sys.exc_info()
+                        broken = _is_disconnect(e)
+
+                        if pool is None:
+                            db.execute('rollback')
+                        elif not broken:
+                            broken = not _rollback(db)
 
+                        if not retryable(e):
+                            stats.count('failures')
+                            raise exc_info[0], exc_info[1], exc_info[2]
+
+                        generator = undecorated(*args, **kwargs)
+                        generator.next()
+                        exception = e
+                    else:
+                        db.execute('commit')
+                        stats.count('commits')
+                        return result
                 except Exception as e:
-                    db.execute('rollback')
-                    generator = undecorated(*args, **kwargs)
-                    generator.next()
-                    exception = e
-                else:
-                    db.execute('commit')
-                    return result
+                    broken = broken or _is_disconnect(e)
+                    raise
+                finally:
+                    if pool is not None:
+                        pool._unbind()
+                        pool.checkin(db, broken = broken)
+
+            stats.count('aborts')
             raise exception
         return decorated
     return decorator
 
 
+# MySQL server errors: deadlock found, lock wait timeout exceeded.
+_RETRYABLE_CODES = (1213, 1205)
+# SQLSTATEs: serialization failure, deadlock detected.
+_RETRYABLE_SQLSTATES = ('40001', '40P01')
+_RETRYABLE_MESSAGES = ('deadlock', 'could not serialize', 'lock wait timeout', 'database is locked')
+
+def is_retryable(exception):
+    """
+    Whether a transaction that failed with 'exception' might succeed if run again:
+    deadlocks, serialization failures, lock timeouts and lost connections.
+    """
+    if _is_disconnect(exception):
+        return True
+
+    args = getattr(exception, 'args', ())
+
+    if args and args[0] in _RETRYABLE_CODES:
+        return True
+
+    if getattr(exception, 'pgcode', None) in _RETRYABLE_SQLSTATES:
+        return True
+
+    message = str(exception).lower()
+    return any(m in message for m in _RETRYABLE_MESSAGES)
+
+
+class TransactionStats(object):
+    """
+    Counts, for one transactional function: attempts, retries, commits, failures
+    (non-retryable errors) and aborts (retries exhausted).
+    """
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counts = dict(attempts = 0, retries = 0, commits = 0, failures = 0, aborts = 0)
+
+    def count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counts)
+
+
+_transaction_stats = instrument.StatsRegistry(TransactionStats)
+
+def transaction_stats(reset = False):
+    """
+    Returns a snapshot of every transactional function's TransactionStats, by
+    function name (qualified with its class, for methods).
+    """
+    return _transaction_stats.snapshot(reset)
+
+def _register_stats(undecorated, frame):
+    return _transaction_stats.register(instrument.qualified_name(undecorated, frame))
+
+
+class PoolTimeout(RuntimeError):
+    pass
+
+
+class ConnectionPool(object):
+    """
+    A thread-safe pool of connections made by calling 'connect', keeping at least
+    'min_size' and at most 'max_size' of them.  Checking out waits up to
+    'checkout_timeout' seconds (forever if None) for a free connection, and
+    raises PoolTimeout after that.  Connections idle for more than 'idle_timeout'
+    seconds are closed, down to 'min_size', and connections idle for more than
+    'health_check_interval' seconds are tested with 'health_check' (a
+    "select 1" by default) before being handed out, and replaced if they fail.
+    Connections which fail with a lost-connection error are discarded, so the
+    next checkout reconnects.
+
+    The pool may be used in place of a connection: its methods check a
+    connection out for a single call, or use the connection checked out by the
+    'transaction' decorator currently running on this thread.  A transaction
+    nested in another on the same pool and thread joins it: it runs on the outer
+    transaction's connection, without a begin or commit of its own, and its
+    errors propagate to the outer transaction, which retries as a whole.
+    """
+    def __init__(self, connect, min_size = 0, max_size = 10, checkout_timeout = None,
+                 idle_timeout = 300, health_check_interval = 30, health_check = None):
+        if min_size > max_size:
+            raise ValueError("ConnectionPool min_size ({0}) is larger than its max_size ({1}).".format(min_size, max_size))
+
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.checkout_timeout = checkout_timeout
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.health_check = health_check or _select_one
+        self.wait_time = instrument.Histogram.latency()
+        self.checkout_time = instrument.Histogram.latency()
+        self.created = 0
+        self.discarded = 0
+        self.timeouts = 0
+        self._idle = []
+        self._checked_out = dict()
+        self._size = 0
+        self._condition = threading.Condition(threading.Lock())
+        self._local = threading.local()
+
+        for connection in [self.checkout() for i in xrange(min_size)]:
+            self.checkin(connection)
+
+    def checkout(self):
+        started = time.time()
+        deadline = started + self.checkout_timeout if self.checkout_timeout is not None else None
+
+        with self._condition:
+            while True:
+                self._evict_idle()
+
+                if self._idle:
+                    connection, idle_since = self._idle.pop()
+                    break
+
+                if self._size < self.max_size:
+                    self._size += 1
+                    connection, idle_since = None, None
+                    break
+
+                remaining = deadline - time.time() if deadline is not None else None
+
+                if remaining is not None and remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeout("Timed out waiting for a database connection.")
+
+                self._condition.wait(remaining)
+
+        try:
+            if connection is None:
+                connection = self._connect()
+            elif time.time() - idle_since > self.health_check_interval and not self._healthy(connection):
+                self._close(connection)
+                connection = self._connect()
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+
+        now = time.time()
+        self.wait_time.add(now - started)
+
+        with self._condition:
+            self._checked_out[id(connection)] = now
+
+        return connection
+
+    def checkin(self, connection, broken = False):
+        with self._condition:
+            checked_out_at = self._checked_out.pop(id(connection), None)
+
+            if broken:
+                self._size -= 1
+                self.discarded += 1
+            else:
+                self._idle.append((connection, time.time()))
+
+            self._condition.notify()
+
+        if checked_out_at is not None:
+            self.checkout_time.add(time.time() - checked_out_at)
+
+        if broken:
+            self._close(connection)
+
+    def close(self):
+        with self._condition:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+
+        for connection, idle_since in idle:
+            self._close(connection)
+
+    def stats(self):
+        return dict(
+            size = self._size,
+            idle = len(self._idle),
+            checked_out = len(self._checked_out),
+            created = self.created,
+            discarded = self.discarded,
+            timeouts = self.timeouts,
+            wait_time = self.wait_time.snapshot(),
+            checkout_time = self.checkout_time.snapshot()
+        )
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def method(*args, **kwargs):
+            connection = self._bound()
+
+            if connection is not None:
+                return getattr(connection, name)(*args, **kwargs)
+
+            connection = self.checkout()
+            broken = False
+
+            try:
+                return getattr(connection, name)(*args, **kwargs)
+            except Exception as e:
+                broken = _is_disconnect(e)
+                raise
+            finally:
+                self.checkin(connection, broken = broken)
+
+        method.__name__ = name
+        return method
+
+    def _bound(self):
+        return getattr(self._local, 'connection', None)
+
+    def _bind(self, connection):
+        self._local.connection = connection
+
+    def _unbind(self):
+        self._local.connection = None
+
+    def _connect(self):
+        connection = self.connect()
+        self.created += 1
+        return connection
+
+    def _healthy(self, connection):
+        try:
+            self.health_check(connection)
+            return True
+        except Exception:
+            logging.warning("Discarding database connection which failed its health check.", exc_info = True)
+            with self._condition:
+                self.discarded += 1
+            return False
+
+    def _evict_idle(self):
+        # called with the condition held; the oldest idle connections are at the front.
+        expired_before = time.time() - self.idle_timeout
+
+        while self._idle and self._size > self.min_size and self._idle[0][1] < expired_before:
+            connection, idle_since = self._idle.pop(0)
+            self._size -= 1
+            self.discarded += 1
+            self._close(connection)
+
+    def _close(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+
+def _rollback(connection):
+    try:
+        connection.execute('rollback')
+        return True
+    except Exception:
+        logging.warning("Rollback failed; discarding the connection.", exc_info = True)
+        return False
+
+def _select_one(connection):
+    connection.execute("select 1")
+
+
+# MySQL client errors: server has gone away, lost connection, lost connection during query.
+_DISCONNECT_CODES = (2006, 2013, 2055)
+
+def _is_disconnect(exception):
+    if exception is None:
+        return False
+
+    args = getattr(exception, 'args', ())
+
+    if args and args[0] in _DISCONNECT_CODES:
+        return True
+
+    message = str(exception).lower()
+    return 'gone away' in message or 'lost connection' in message or 'closed database' in message
+
+
 class InList(object):
-    def __init__(self, list):
+    """
+    A list of values to be expanded into an "IN (%s, %s, ...)" clause.  With
+    'bucket', the list is padded to the next power of two by repeating its last
+    value, so that lists of similar lengths share the same SQL text (and so the
+    server's statement cache); its values must then be passed as 'parameters',
+    rather than 'list'.
+    """
+    def __init__(self, list, bucket = False):
         self.list = list
+        self.bucket = bucket
+
+    @property
+    def parameters(self):
+        values = self.list
+
+        if self.bucket and values:
+            padding = _bucket_size(len(values)) - len(values)
+
+            if padding:
+                values = list(values) + [values[-1]] * padding
+
+        return values
+
+    def chunks(self, size):
+        return [InList(self.list[i:i + size], self.bucket) for i in xrange(0, len(self.list), size)]
 
     def __parameterize__(self, format_spec):
-        return self.list, str(self)
+        parameters = self.parameters
+        return parameters, _placeholders(len(parameters))
 
     def __str__(self):
-        import itertools
-        return "({0})".format(', '.join(itertools.repeat("%s", len(self.list))))
\ No newline at end of file
+        return _placeholders(len(self.parameters))
+
+
+_NOT_IN = re.compile(r'\bnot\s+in\s*\{0\}', re.IGNORECASE)
+
+def query_in(db, query, *args, **kwargs):
+    """
+    Runs db.query once for every 'chunk_size' (default 1000) values of the InList
+    among 'args', and returns all of the rows.  'query' marks the InList's place
+    with {0}, and its other "%s" parameters are the rest of 'args', which should
+    be given in the order they appear in the query, InList included.  Pass
+    'method' to run something other than db.query.
+
+    The rows are simply concatenated, so ORDER BY, LIMIT, DISTINCT, GROUP BY
+    and aggregates apply to each chunk rather than to the whole result; sort,
+    limit or combine the rows afterwards instead.  An empty InList runs no
+    query and returns [], and NOT IN, which no chunking can answer, raises
+    ValueError.
+    """
+    chunk_size = kwargs.pop('chunk_size', 1000)
+    method = getattr(db, kwargs.pop('method', 'query'))
+    in_lists = [a for a in args if isinstance(a, InList)]
+
+    if len(in_lists) != 1:
+        raise ValueError("query_in requires exactly one InList argument.")
+
+    if _NOT_IN.search(query):
+        raise ValueError("query_in can't chunk NOT IN: {0!r}".format(query))
+
+    in_list = in_lists[0]
+    rows = []
+
+    for chunk in in_list.chunks(chunk_size):
+        parameters = []
+
+        for arg in args:
+            if arg is in_list:
+                parameters.extend(chunk.parameters)
+            else:
+                parameters.append(arg)
+
+        result = method(query.format(chunk), *parameters)
+
+        if result:
+            rows.extend(result)
+
+    return rows
+
+
+def insert_many(db, table, columns, rows, chunk_size = 500, multi_row = True):
+    """
+    Inserts 'rows' (sequences of values for 'columns') into 'table'.  With
+    'multi_row', each 'chunk_size' rows are sent as a single INSERT with that
+    many VALUES tuples; otherwise, every row goes through db.executemany.
+    """
+    rows = list(rows)
+
+    if not rows:
+        return
+
+    if not multi_row:
+        return db.executemany(_insert_sql(table, tuple(columns), 1), rows)
+
+    for i in xrange(0, len(rows), chunk_size):
+        chunk = rows[i:i + chunk_size]
+        parameters = [value for row in chunk for value in row]
+        db.execute(_insert_sql(table, tuple(columns), len(chunk)), *parameters)
+
+
+def _bucket_size(n):
+    size = 1
+
+    while size < n:
+        size <<= 1
+
+    return size
+
+
+_placeholder_cache = dict()
+
+def _placeholders(n):
+    try:
+        return _placeholder_cache[n]
+    except KeyError:
+        sql = _placeholder_cache[n] = "({0})".format(', '.join(["%s"] * n))
+        return sql
+
+
+_insert_cache = dict()
+
+def _insert_sql(table, columns, n):
+    key = (table, columns, n)
+
+    try:
+        return _insert_cache[key]
+    except KeyError:
+        row = _placeholders(len(columns))
+        sql = _insert_cache[key] = "INSERT INTO {0} ({1}) VALUES {2}".format(table, ', '.join(columns), ', '.join([row] * n))
+        return sql
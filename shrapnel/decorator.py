@@ -1,5 +1,7 @@
 from functools import wraps, partial
 
+import logging
+import threading
 import tornado.ioloop
 
 def background_func(func):
@@ -26,11 +28,65 @@ def background_func(func):
 def nonimmediate(func):
     """
     Decorator that makes *func* return immediately and be called during the
-    next iteration of the IO loop.
+    next iteration of the IO loop.  The IO loop is looked up when *func* is
+    called, so decorating at import time doesn't create one.
     """
-    ioloop = tornado.ioloop.IOLoop.instance()
     @wraps(func)
     def delayed_call(*args, **kwargs):
         callback = partial(func, *args, **kwargs)
-        ioloop.add_callback(callback)
+        tornado.ioloop.IOLoop.instance().add_callback(callback)
     return delayed_call
+
+def ioloop_callback(func, io_loop = None):
+    """
+    Wraps *func* so that calling it, from any thread, runs it on the IO loop.
+    Calls that arrive before the IO loop gets around to them are all run from a
+    single IO loop callback, rather than waking the loop once per call.
+    """
+    queue = _IOLoopQueue.instance(io_loop or tornado.ioloop.IOLoop.instance())
+    @wraps(func)
+    def delivered(*args, **kwargs):
+        queue.put(partial(func, *args, **kwargs))
+    return delivered
+
+class _IOLoopQueue(object):
+    _instances = dict()
+    _instances_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls, io_loop):
+        with cls._instances_lock:
+            queue = cls._instances.get(id(io_loop))
+
+            if queue is None or queue.io_loop is not io_loop:
+                queue = cls._instances[id(io_loop)] = cls(io_loop)
+
+            return queue
+
+    def __init__(self, io_loop):
+        self.io_loop = io_loop
+        self._callbacks = []
+        self._scheduled = False
+        self._lock = threading.Lock()
+
+    def put(self, callback):
+        with self._lock:
+            self._callbacks.append(callback)
+
+            if self._scheduled:
+                return
+
+            self._scheduled = True
+
+        self.io_loop.add_callback(self._drain)
+
+    def _drain(self):
+        with self._lock:
+            callbacks, self._callbacks = self._callbacks, []
+            self._scheduled = False
+
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                logging.exception("Exception in callback {0!r}".format(callback))
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+fakememcache.py
+
+An in-memory memcached stand-in for tests.
+"""
+
+import SocketServer
+import socket
+import threading
+import time
+
+
+# memcached treats expiry times longer than this as absolute unix times.
+_RELATIVE_EXPIRY_LIMIT = 60 * 60 * 24 * 30
+
+
+class Server(object):
+    """
+    An in-memory stand-in for memcached, for exercising memcache clients offline.
+    It speaks enough of the text protocol for shrapnel's clients (get, set, add,
+    delete and flush_all), serving each connection on its own daemon thread.
+    'port' 0 picks a free port; 'servers' is the list to pass to a client.
+    Every command line received is kept in 'commands'.
+    """
+    def __init__(self, host = '127.0.0.1', port = 0):
+        self.data = dict()
+        self.commands = []
+        self.lock = threading.Lock()
+        self._connections = dict()
+        self._server = _TCPServer((host, port), _Handler)
+        self._server.memcache = self
+        self._thread = None
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    @property
+    def servers(self):
+        return ["{0[0]}:{0[1]}".format(self.address)]
+
+    def start(self):
+        self._thread = threading.Thread(target = self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+        # clients may still hold their connections open; end them, so that no
+        # handler thread outlives the server.
+        with self.lock:
+            connections = self._connections.items()
+
+        for connection, thread in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+            thread.join(1.0)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.data.get(key)
+
+            if entry and entry[1] and entry[1] <= time.time():
+                del self.data[key]
+                entry = None
+
+            return entry
+
+    def store(self, verb, key, flags, expires, value):
+        if expires and expires <= _RELATIVE_EXPIRY_LIMIT:
+            expires += time.time()
+
+        with self.lock:
+            if verb == 'add' and key in self.data and not (self.data[key][1] and self.data[key][1] <= time.time()):
+                return False
+
+            self.data[key] = (flags, expires, value)
+            return True
+
+    def delete(self, key):
+        with self.lock:
+            return self.data.pop(key, None) is not None
+
+    def flush_all(self):
+        with self.lock:
+            self.data.clear()
+
+
+class _TCPServer(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+
+        with self.server.memcache.lock:
+            self.server.memcache._connections[self.connection] = threading.current_thread()
+
+    def finish(self):
+        with self.server.memcache.lock:
+            self.server.memcache._connections.pop(self.connection, None)
+
+        SocketServer.StreamRequestHandler.finish(self)
+
+    def handle(self):
+        memcache = self.server.memcache
+
+        while True:
+            line = self.rfile.readline()
+
+            if not line:
+                return
+
+            memcache.commands.append(line.rstrip("\r\n"))
+            parts = line.split()
+
+            if not parts:
+                self.wfile.write("ERROR\r\n")
+            elif parts[0] == 'get' and len(parts) > 1:
+                for key in parts[1:]:
+                    entry = memcache.get(key)
+
+                    if entry:
+                        flags, expires, value = entry
+                        self.wfile.write("VALUE {0} {1} {2}\r\n{3}\r\n".format(key, flags, len(value), value))
+
+                self.wfile.write("END\r\n")
+            elif parts[0] in ('set', 'add') and len(parts) == 5:
+                verb, key, flags, expires, length = parts
+                value = self.rfile.read(int(length) + 2)[:-2]
+                stored = memcache.store(verb, key, int(flags), int(expires), value)
+                self.wfile.write("STORED\r\n" if stored else "NOT_STORED\r\n")
+            elif parts[0] == 'delete' and len(parts) == 2:
+                self.wfile.write("DELETED\r\n" if memcache.delete(parts[1]) else "NOT_FOUND\r\n")
+            elif parts[0] == 'flush_all':
+                memcache.flush_all()
+                self.wfile.write("OK\r\n")
+            else:
+                self.wfile.write("ERROR\r\n")
@@ -1,4 +1,5 @@
-import threading, time, os, sys
+import bisect, collections, json, threading, time, os, signal, sys, traceback
+import logging, logging.handlers
 
 class ProfilingThread(threading.Thread):
     daemon = True
@@ -18,3 +19,357 @@ class ProfilingThread(threading.Thread):
             callback_len = len(self.ioloop._callbacks)
             print >> outfile, ', '.join([str(time.time()), str(handler_len), str(event_len), str(callback_len)])
             time.sleep(5)
+
+
+class LoopLagMonitor(object):
+    """
+    Measures how late the IOLoop runs a probe scheduled every 'interval' seconds,
+    into 'lag', a Histogram that is rolled over into 'windows' every 'window'
+    seconds.  A watchdog thread checks on the probe, and once it is overdue by
+    more than 'threshold' seconds, records what the IOLoop's thread is doing
+    in 'stalls' (the most recent 'history' of them), and, given a 'path', in a
+    rotating file of JSON lines.
+    """
+    def __init__(self, ioloop, interval = 0.5, threshold = 0.1, window = 60, history = 100,
+                 path = None, max_bytes = 10 * 1024 * 1024, backup_count = 5):
+        self.ioloop = ioloop
+        self.interval = interval
+        self.threshold = threshold
+        self.window = window
+        self.lag = Histogram.latency()
+        self.windows = collections.deque(maxlen = history)
+        self.stalls = collections.deque(maxlen = history)
+        self._logger = None
+        self._running = False
+        self._due = None
+        self._captured = None
+        self._thread_id = None
+        self._window_started = time.time()
+
+        if path:
+            handler = logging.handlers.RotatingFileHandler(path, maxBytes = max_bytes, backupCount = backup_count)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self._logger = logging.getLogger('shrapnel.looplag.{0}'.format(id(self)))
+            self._logger.propagate = False
+            self._logger.addHandler(handler)
+
+    def start(self):
+        """
+        Starts monitoring; call from the IOLoop's thread.
+        """
+        self._running = True
+        self._thread_id = threading.current_thread().ident
+        self._schedule()
+
+        watchdog = threading.Thread(target = self._watch)
+        watchdog.daemon = True
+        watchdog.start()
+
+    def stop(self):
+        self._running = False
+
+    def _schedule(self):
+        self._due = time.time() + self.interval
+        self.ioloop.add_timeout(self._due, self._probe)
+
+    def _probe(self):
+        now = time.time()
+        self._thread_id = threading.current_thread().ident
+        self.lag.add(max(0, now - self._due))
+
+        if now - self._window_started >= self.window:
+            self.windows.append(dict(time = now, lag = self.lag.snapshot()))
+            self._write(self.windows[-1])
+            self.lag.reset()
+            self._window_started = now
+
+        if self._running:
+            self._schedule()
+
+    def _watch(self):
+        while self._running:
+            time.sleep(self.threshold / 2)
+            due = self._due
+
+            if due is None or due == self._captured or self._thread_id is None:
+                continue
+
+            lag = time.time() - due
+
+            if lag > self.threshold:
+                self._captured = due
+                frame = sys._current_frames().get(self._thread_id)
+                stall = dict(
+                    time = time.time(),
+                    lag = lag,
+                    stack = traceback.format_stack(frame) if frame else None
+                )
+                self.stalls.append(stall)
+                self._write(stall)
+
+    def _write(self, record):
+        if self._logger:
+            self._logger.warning(json.dumps(record))
+
+
+class SamplingProfiler(object):
+    """
+    A statistical profiler: every 'interval' seconds of wall-clock time, a daemon
+    thread records the stack of every other thread, so that threads blocked in
+    I/O (such as an idle IOLoop's poll) are sampled as well as busy ones.
+    'collapsed' reports the samples as "thread;outermost;...;innermost count"
+    lines, as flame graph tools expect.  Only one profiler can run at a time.
+    """
+    _running = None
+    _lock = threading.Lock()
+
+    def __init__(self, interval = 0.005):
+        if not interval > 0:
+            raise ValueError("SamplingProfiler's interval must be positive, not {0!r}.".format(interval))
+
+        self.interval = interval
+        self.samples = collections.defaultdict(int)
+        self._thread = None
+        self._stopping = False
+
+    @property
+    def running(self):
+        return SamplingProfiler._running is self
+
+    def start(self):
+        with SamplingProfiler._lock:
+            if SamplingProfiler._running is not None:
+                raise RuntimeError("A SamplingProfiler is already running.")
+
+            thread = threading.Thread(target = self._run, name = 'SamplingProfiler')
+            thread.daemon = True
+            thread.start()
+            self._thread = thread
+            SamplingProfiler._running = self
+
+    def stop(self):
+        with SamplingProfiler._lock:
+            if not self.running:
+                return
+
+            self._stopping = True
+            self._thread.join()
+            SamplingProfiler._running = None
+
+    def _run(self):
+        while not self._stopping:
+            time.sleep(self.interval)
+            self._sample()
+
+    def _sample(self):
+        current = threading.current_thread().ident
+
+        for ident, frame in sys._current_frames().iteritems():
+            if ident == current:
+                continue
+
+            stack = []
+
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{0} ({1}:{2})".format(code.co_name, code.co_filename, code.co_firstlineno))
+                frame = frame.f_back
+
+            thread = threading._active.get(ident)
+            stack.append(thread.name if thread else "thread-{0}".format(ident))
+            self.samples[';'.join(reversed(stack))] += 1
+
+    def collapsed(self):
+        return ''.join("{0} {1}\n".format(stack, count) for (stack, count) in sorted(self.samples.iteritems()))
+
+    def dump(self, path):
+        with open(path, 'w') as outfile:
+            outfile.write(self.collapsed())
+
+
+_profiler_toggle = None
+
+def install_profiler_toggle(signum = signal.SIGUSR2, interval = 0.005, directory = '.'):
+    """
+    Makes 'signum' start a SamplingProfiler, and stop it again, writing its
+    samples to profile-<pid>-<time>.collapsed in 'directory'.
+    """
+    global _profiler_toggle
+    _profiler_toggle = dict(signum = signum, interval = interval, directory = directory)
+    state = dict(profiler = None)
+
+    def toggle(signum, frame):
+        profiler = state['profiler']
+
+        if profiler and profiler.running:
+            profiler.stop()
+            path = os.path.join(directory, 'profile-{0}-{1}.collapsed'.format(os.getpid(), int(time.time())))
+            profiler.dump(path)
+            state['profiler'] = None
+        else:
+            state['profiler'] = SamplingProfiler(interval)
+            state['profiler'].start()
+
+    signal.signal(signum, toggle)
+
+def reset_profiler_toggle():
+    """
+    Reinstalls the profiler toggle, if any, in a forked child, which doesn't
+    inherit a running profiler's thread.
+    """
+    SamplingProfiler._running = None
+    SamplingProfiler._lock = threading.Lock()
+
+    if _profiler_toggle:
+        install_profiler_toggle(**_profiler_toggle)
+
+
+class StatsDumpThread(threading.Thread):
+    """
+    Every 'interval' seconds, appends the result of calling 'provider' to a file
+    as a line of JSON, prefixed with the time.
+    """
+    daemon = True
+    def __init__(self, provider, name = 'stats', interval = 60):
+        self.provider = provider
+        self.name_prefix = name
+        self.interval = interval
+        threading.Thread.__init__(self)
+
+    def run(self):
+        pid = os.getpid()
+        outfile_path = os.path.abspath('{0}-{1}.log'.format(self.name_prefix, pid))
+        outfile = open(outfile_path, 'a')
+        while True:
+            time.sleep(self.interval)
+            print >> outfile, json.dumps(dict(time = time.time(), stats = self.provider()))
+            outfile.flush()
+
+
+def qualified_name(func, frame = None):
+    """
+    'func's module and name, including the class it's a method of when 'frame' is
+    the frame of the class body defining it, as sys._getframe(1) is for a
+    decorator applied there.
+    """
+    name = func.__name__
+
+    # only a class body's locals have a __module__ (a module's are its globals).
+    if frame is not None and frame.f_locals is not frame.f_globals and '__module__' in frame.f_locals:
+        name = "{0}.{1}".format(frame.f_code.co_name, name)
+
+    return "{0}.{1}".format(func.__module__, name)
+
+
+class StatsRegistry(object):
+    """
+    The stats of every decorated function of some kind, by name.  'register'
+    creates them by calling 'factory' with the name and any further arguments;
+    they must have 'name', 'snapshot' and 'reset'.
+    """
+    def __init__(self, factory):
+        self.factory = factory
+        self._stats = dict()
+        self._lock = threading.Lock()
+
+    def register(self, name, *args):
+        with self._lock:
+            stats = self._stats.get(name)
+
+            if stats is None:
+                stats = self._stats[name] = self.factory(name, *args)
+
+        return stats
+
+    def snapshot(self, reset = False):
+        with self._lock:
+            all_stats = self._stats.values()
+
+        result = dict()
+
+        for stats in all_stats:
+            result[stats.name] = stats.snapshot()
+
+            if reset:
+                stats.reset()
+
+        return result
+
+
+class Histogram(object):
+    """
+    A thread-safe histogram over fixed bucket boundaries.  Percentiles are
+    estimated as the upper bound of the bucket they fall in.
+    """
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        self._lock = threading.Lock()
+        self.reset()
+
+    @classmethod
+    def exponential(cls, start, factor, count):
+        return cls(start * factor ** i for i in xrange(count))
+
+    @classmethod
+    def latency(cls):
+        # 100us to ~105s
+        return cls.exponential(0.0001, 2, 21)
+
+    @classmethod
+    def size(cls):
+        # 64B to 32MB
+        return cls.exponential(64, 2, 20)
+
+    def reset(self):
+        with self._lock:
+            self.counts = [0] * (len(self.bounds) + 1)
+            self.count = 0
+            self.total = 0
+            self.min = None
+            self.max = None
+
+    def add(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += value
+
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def percentile(self, p):
+        with self._lock:
+            return self._percentile(p)
+
+    def _percentile(self, p):
+        if not self.count:
+            return None
+
+        threshold = self.count * p / 100.0
+        seen = 0
+
+        for index, count in enumerate(self.counts):
+            seen += count
+
+            if seen >= threshold:
+                return min(self.bounds[index], self.max) if index < len(self.bounds) else self.max
+
+        return self.max
+
+    def snapshot(self):
+        with self._lock:
+            return dict(
+                count = self.count,
+                total = self.total,
+                mean = float(self.total) / self.count if self.count else None,
+                min = self.min,
+                max = self.max,
+                p50 = self._percentile(50),
+                p90 = self._percentile(90),
+                p99 = self._percentile(99),
+                buckets = [(bound, count) for (bound, count) in zip(self.bounds + [None], self.counts) if count]
+            )
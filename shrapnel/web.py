@@ -9,10 +9,16 @@ Copyright (c) 2010 Medium Entertainment, Inc. All rights reserved.
 
 import collections
 import functools
-import itertools
+import math
+import re
+import sys
 import threading
+import time
 import tornado.ioloop
+import tornado.web
 import urllib
+from shrapnel.decorator import ioloop_callback
+from shrapnel import instrument
 
 
 def url(base, **query):
@@ -20,90 +26,588 @@ def url(base, **query):
 
 
 def flagger(target, callback):
+    """
+    Wraps 'target' so that its result, or the exception it raised, is passed
+    to 'callback' on the IOLoop, whichever thread 'target' runs on.  If the
+    callback has an 'is_cancelled' function (as Plan.flag's callbacks do) which
+    returns True by the time the wrapper runs, 'target' is skipped.
+    """
+    is_cancelled = getattr(callback, 'is_cancelled', None)
+    callback = ioloop_callback(callback)
+
     def wrapper(*args, **kwargs):
+        if is_cancelled and is_cancelled():
+            return
+
         try:
             result = target(*args, **kwargs)
         except Exception as e:
-            import sys
             callback(None, _WaiterException(sys.exc_info()))
         else:
             callback(result)
 
     return wrapper
 
+
+class RequestTracker(object):
+    """
+    Wraps a Tornado application to count the requests it has in flight, from the
+    time the HTTPServer hands one over until it's finished, and to turn requests
+    away with a bare 503 before they reach a handler when the server is
+    overloaded:
+
+      'max_in_flight'  requests are already in flight,
+      'max_queued'     tasks are waiting for BackgroundFunction's thread pool,
+      'max_latency'    seconds is exceeded by the moving average of request
+                       times while requests are still in flight (the average
+                       decays towards 0 with a time constant of 'latency_decay'
+                       seconds while no requests finish), or
+      'route_limits'   is a list of (path pattern, limit) pairs, tried in order
+                       and matched as Tornado matches its handlers, limiting the
+                       number of each route's requests in flight.
+
+    A request stops counting once it's finished, or once its client disconnects
+    from an asynchronous handler.  Anything else is looked up on the application.
+    """
+    latency_weight = 0.1
+    latency_decay = 10
+    retry_after = 1
+
+    def __init__(self, application, max_in_flight = None, max_queued = None, max_latency = None, route_limits = None):
+        self.application = application
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.max_latency = max_latency
+        self.in_flight = 0
+        self._latency = 0.0
+        self._latency_updated = time.time()
+        self.request_time = instrument.Histogram.latency()
+        self.rejected = collections.defaultdict(int)
+        self._routes = []
+        self._route_in_flight = dict()
+
+        if isinstance(route_limits, dict):
+            route_limits = route_limits.items()
+
+        for pattern, limit in route_limits or ():
+            if not pattern.endswith('$'):
+                pattern += '$'
+
+            self._routes.append((re.compile(pattern), pattern, limit))
+            self._route_in_flight[pattern] = 0
+
+    @property
+    def latency(self):
+        # a few long-lived requests mustn't hold the average up, and shed
+        # everything else, until they finish.
+        idle = max(0, time.time() - self._latency_updated)
+        return self._latency * math.exp(-idle / self.latency_decay)
+
+    @property
+    def background_jobs(self):
+        from shrapnel.classtools import BackgroundFunction
+        pool = BackgroundFunction.threadpool
+        return pool.active + pool.queued
+
+    def stats(self):
+        from shrapnel.classtools import BackgroundFunction
+
+        return dict(
+            in_flight = self.in_flight,
+            routes = dict(self._route_in_flight),
+            latency = self.latency,
+            request_time = self.request_time.snapshot(),
+            rejected = dict(self.rejected),
+            background = BackgroundFunction.threadpool.stats()
+        )
+
+    def __call__(self, request):
+        route, limit = self._route(request.path)
+        reason = self._overloaded(route, limit)
+
+        if reason:
+            self.rejected[reason] += 1
+            return self._reject(request)
+
+        self.in_flight += 1
+
+        if route:
+            self._route_in_flight[route] += 1
+
+        started = time.time()
+        finish = request.finish
+        finished = [False]
+
+        def release(completed):
+            if not finished[0]:
+                finished[0] = True
+                self.in_flight -= 1
+
+                if route:
+                    self._route_in_flight[route] -= 1
+
+                if completed:
+                    elapsed = time.time() - started
+                    latency = self.latency
+                    self._latency = latency + self.latency_weight * (elapsed - latency)
+                    self._latency_updated = time.time()
+                    self.request_time.add(elapsed)
+
+        def tracked_finish():
+            release(True)
+            return finish()
+
+        request.finish = tracked_finish
+        result = self.application(request)
+
+        if not finished[0]:
+            self._release_on_close(request, functools.partial(release, False))
+
+        return result
+
+    def _release_on_close(self, request, release):
+        stream = getattr(getattr(request, 'connection', None), 'stream', None)
+
+        if stream is None:
+            return
+
+        if stream.closed():
+            return release()
+
+        # the handler has set its on_connection_close as the stream's only close
+        # callback (clearing it when it finishes), so chain onto it.
+        on_close = stream._close_callback
+
+        def tracked_close():
+            release()
+
+            if on_close:
+                on_close()
+
+        stream.set_close_callback(tracked_close)
+
+    def _route(self, path):
+        for regex, pattern, limit in self._routes:
+            if regex.match(path):
+                return pattern, limit
+
+        return None, None
+
+    def _overloaded(self, route, limit):
+        if self.max_in_flight is not None and self.in_flight >= self.max_in_flight:
+            return 'in_flight'
+
+        if route and self._route_in_flight[route] >= limit:
+            return 'route'
+
+        if self.max_queued is not None:
+            from shrapnel.classtools import BackgroundFunction
+
+            if BackgroundFunction.threadpool.queued >= self.max_queued:
+                return 'queued'
+
+        # without requests in flight, the average can't recover, so stop shedding.
+        if self.max_latency is not None and self.in_flight and self.latency > self.max_latency:
+            return 'latency'
+
+        return None
+
+    def _reject(self, request):
+        request.write("HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nRetry-After: {0}\r\n\r\n".format(self.retry_after))
+        request.finish()
+
+    def __getattr__(self, name):
+        return getattr(self.application, name)
+
+
+class ProfilerHandler(tornado.web.RequestHandler):
+    """
+    An admin handler that runs an instrument.SamplingProfiler for ?seconds=N (10
+    by default, and at most 'max_seconds'), sampling every ?interval=N seconds
+    (0.005 by default, between 'min_interval' and 'max_interval'), and responds
+    with its collapsed stacks.
+    """
+    max_seconds = 300
+    min_interval = 0.001
+    max_interval = 1
+
+    @tornado.web.asynchronous
+    def get(self):
+        try:
+            seconds = float(self.get_argument('seconds', 10))
+            interval = float(self.get_argument('interval', 0.005))
+        except ValueError:
+            self.send_error(400)
+            return
+
+        if not 0 < seconds <= self.max_seconds or not self.min_interval <= interval <= self.max_interval:
+            self.send_error(400)
+            return
+
+        profiler = self._profiler = instrument.SamplingProfiler(interval)
+
+        try:
+            profiler.start()
+        except RuntimeError:
+            self.send_error(409)
+            return
+
+        self._timeout = tornado.ioloop.IOLoop.instance().add_timeout(
+            time.time() + seconds,
+            self.async_callback(functools.partial(self._on_profiled, profiler))
+        )
+
+    def on_connection_close(self):
+        tornado.ioloop.IOLoop.instance().remove_timeout(self._timeout)
+        self._profiler.stop()
+
+    def _on_profiled(self, profiler):
+        profiler.stop()
+        self.set_header('Content-Type', 'text/plain')
+        self.finish(profiler.collapsed())
+
+
+class Future(object):
+    """
+    The eventual result of some background work.  'resolve' may be called from
+    any thread, and has the same signature as the callbacks that flagger and
+    Plan.flag deal in.  Done callbacks are passed the future and always run on
+    the IOLoop.
+    """
+    def __init__(self, io_loop = None):
+        self._io_loop = io_loop
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        if not self._done:
+            raise RuntimeError("Future.result() called before the future was resolved.")
+
+        if self._exception:
+            exc_info = getattr(self._exception, 'exc_info', None)
+
+            if exc_info:
+                raise self._exception, None, exc_info[2]
+
+            raise self._exception
+
+        return self._result
+
+    def exception(self):
+        return self._exception
+
+    def resolve(self, result = None, exception = None):
+        with self._lock:
+            if self._done:
+                raise RuntimeError("Future resolved twice.")
+
+            self._result = result
+            self._exception = exception
+            self._done = True
+            callbacks, self._callbacks = self._callbacks, []
+
+        for callback in callbacks:
+            self._schedule(callback)
+
+    def set_result(self, result):
+        self.resolve(result)
+
+    def set_exception(self, exception):
+        self.resolve(None, exception)
+
+    def add_done_callback(self, callback):
+        with self._lock:
+            if not self._done:
+                self._callbacks.append(callback)
+                return
+
+        self._schedule(callback)
+
+    def _schedule(self, callback):
+        ioloop_callback(callback, self._io_loop)(self)
+
 class Plan(object):
-    def __init__(self, handler):
+    """
+    Runs waiters (see 'wait') once all of the keys they wait on have been flagged.
+    Each waiter counts down its outstanding keys as they're flagged, and waiters
+    that become ready are run in batches of up to 'max_waiters_per_turn' per
+    IOLoop iteration.
+
+    A key flagged with a 'timeout', or any key still outstanding when the plan's
+    own 'timeout' passes, is flagged with a PlanTimeout, which its waiters see
+    through WaiterResult.timed_out and get.  The plan's timeout is only held
+    while flagged keys or waiters are outstanding, and every timeout is dropped
+    when the handler finishes, so neither keeps a finished handler alive.  Once
+    the plan times out, is cancelled, or its handler finishes, later flags are
+    ignored and flagged background work that hasn't started yet is skipped.
+
+    'gather' runs a batch of callables in the background, flagging each one's
+    key as it finishes, and wait's 'quorum' lets a waiter run once any K of its
+    keys have succeeded (see WaiterResult.succeeded), or once too many have
+    failed for that to happen, as for hedged requests against replicas.
+    """
+    max_waiters_per_turn = 1000
+
+    def __init__(self, handler, timeout = None):
         self._handler = handler
-        self._waiter_keys = dict()
+        self._waiters = dict()
         self._waiter_results = dict()
         self._lock = threading.Lock()
-        self._callback_queue = collections.deque()
-        self._next_callback = self._handler.async_callback(self._next_in_callback_queue)
+        self._ready = collections.deque()
+        self._drain_scheduled = False
+        self._drain_callback = self._handler.async_callback(self._drain)
         self._ioloop = tornado.ioloop.IOLoop.instance()
+        self._timeouts = dict()
+        self._flagged = set()
+        self._deadline = None
+        self._cancelled = False
+        self._expired = False
+
+        if timeout is not None:
+            self._deadline = time.time() + timeout
+            self._arm()
+
+        finish = handler.finish
+
+        def finish_and_drop_timeouts(*args, **kwargs):
+            self._drop_timeouts()
+            return finish(*args, **kwargs)
+
+        handler.finish = finish_and_drop_timeouts
+
+    @property
+    def cancelled(self):
+        return self._cancelled or self._expired or getattr(self._handler, '_finished', False)
+
+    def cancel(self):
+        """
+        Drops every waiter that hasn't run, and stops the plan from accepting flags.
+        """
+        with self._lock:
+            self._cancelled = True
+            self._waiters.clear()
+            self._ready.clear()
+
+        self._drop_timeouts()
+
+    def _drop_timeouts(self):
+        with self._lock:
+            timeouts, self._timeouts = self._timeouts, dict()
+
+        for timeout in timeouts.itervalues():
+            self._ioloop.remove_timeout(timeout)
+
+    def _arm(self):
+        # (re)adds the plan's timeout, which _set_result drops once nothing is outstanding.
+        with self._lock:
+            if self._deadline is not None and None not in self._timeouts and not self.cancelled:
+                self._timeouts[None] = self._ioloop.add_timeout(self._deadline, self._expire)
+
+    def _expire(self):
+        with self._lock:
+            self._timeouts.pop(None, None)
+            keys = self._waiters.keys()
+
+        for key in keys:
+            self._set_result(key, None, PlanTimeout(key))
+
+        self._expired = True
+        self._drop_timeouts()
+
+    def _expire_key(self, key):
+        with self._lock:
+            self._timeouts.pop(key, None)
+
+        self._set_result(key, None, PlanTimeout(key))
+
+    def wait(self, *keys, **kwargs):
+        quorum = kwargs.pop('quorum', None)
 
-    def wait(self, *keys):
         def decorator(undecorated):
-            self._add_waiter(keys, undecorated)
+            self._add_waiter(keys, undecorated, quorum)
             def replacement(*a, **k):
                 raise RuntimeError("{0.__name__} should not be called directly.".format(undecorated))
             return replacement
         return decorator
 
-    def _add_waiter(self, keys, waiter):
-        call_now = False
-
+    def _add_waiter(self, keys, callback, quorum = None):
         with self._lock:
-            wait_keys = (k for k in keys if k not in self._waiter_results)
-            wait_values = itertools.repeat(True)
-            conditions = dict(itertools.izip(wait_keys, wait_values))
-
-            if conditions:
-                for key in conditions.keys():
-                    if not self._waiter_keys.has_key(key):
-                        self._waiter_keys[key] = []
-                    self._waiter_keys[key].append((conditions, keys, waiter))
+            unique = set(keys)
+            pending = set(k for k in unique if k not in self._waiter_results)
+
+            if quorum is None:
+                remaining = len(pending)
+                failures_allowed = None
             else:
-                call_now = True
+                quorum = min(quorum, len(unique))
+                failed = sum(1 for k in unique - pending if self._waiter_results[k][1] is not None)
+                remaining = quorum - (len(unique) - len(pending) - failed)
+                failures_allowed = len(unique) - quorum - failed
+
+            waiting = remaining > 0 and (failures_allowed is None or failures_allowed >= 0)
 
-        if call_now:
-            waiter(WaiterResult(keys, self._waiter_results))
+            if waiting:
+                waiter = _Waiter(keys, callback, remaining, failures_allowed)
+
+                for key in pending:
+                    self._waiters.setdefault(key, []).append(waiter)
+
+        if waiting:
+            self._arm()
+        else:
+            callback(WaiterResult(keys, self._waiter_results))
+
+    def flag(self, key, timeout = None):
+        with self._lock:
+            self._flagged.add(key)
+            previous = self._timeouts.pop(key, None) if timeout is not None else None
+
+            if timeout is not None:
+                expire = functools.partial(self._expire_key, key)
+                self._timeouts[key] = self._ioloop.add_timeout(time.time() + timeout, expire)
+
+        # flagging a key again replaces its timeout.
+        if previous is not None:
+            self._ioloop.remove_timeout(previous)
+
+        self._arm()
 
-    def flag(self, key):
         @self._handler.async_callback
         def callback(result = None, exception = None):
-            queued = False
+            self._set_result(key, result, exception)
 
-            with self._lock:
-                self._waiter_results[key] = (result, exception)
-                before_waiters = self._waiter_keys.pop(key, tuple())
-                after_waiters = []
+        callback.is_cancelled = lambda: self.cancelled
+        return callback
 
-                for waiter_stuff in before_waiters:
-                    conditions, keys, waiter = waiter_stuff
-                    conditions.pop(key)
+    def gather(self, key, funcs, concurrency = None, needed = None, timeout = None):
+        """
+        Runs each of 'funcs' on BackgroundFunction's thread pool, at most
+        'concurrency' at a time, and flags (key, i) with the result of funcs[i] as
+        it finishes.  Once 'needed' of them have succeeded, the rest aren't
+        started, and their keys are flagged with a PlanSkipped.  Returns the keys,
+        in order, for use with 'wait'.
+        """
+        from shrapnel.classtools import BackgroundFunction
 
-                    if not conditions:
-                        self._callback_queue.append(functools.partial(waiter, WaiterResult(keys, self._waiter_results)))
-                        queued = True
-                    else:
-                        after_waiters.append(waiter_stuff)
+        funcs = list(funcs)
+        keys = tuple((key, i) for i in xrange(len(funcs)))
+        callbacks = [ioloop_callback(self.flag(k, timeout = timeout)) for k in keys]
+        pending = collections.deque(enumerate(funcs))
+        succeeded = [0]
+        lock = threading.Lock()
 
-                if after_waiters:
-                    self._waiter_keys[key] = after_waiters
+        def launch():
+            with lock:
+                if not pending:
+                    return
 
-            if queued:
-                self._ioloop.add_callback(self._next_callback)
+                if needed is not None and succeeded[0] >= needed:
+                    skipped = list(pending)
+                    pending.clear()
+                else:
+                    skipped = None
+                    i, func = pending.popleft()
 
-        return callback
+            if skipped is not None:
+                for i, func in skipped:
+                    callbacks[i](None, PlanSkipped(keys[i]))
+            else:
+                BackgroundFunction.threadpool.submit(run, i, func)
+
+        def run(i, func):
+            if not self.cancelled:
+                try:
+                    result = func()
+                except Exception:
+                    callbacks[i](None, _WaiterException(sys.exc_info()))
+                else:
+                    with lock:
+                        succeeded[0] += 1
+                    callbacks[i](result)
+
+            launch()
+
+        for i in xrange(concurrency or len(funcs)):
+            launch()
+
+        return keys
+
+    def _set_result(self, key, result, exception):
+        with self._lock:
+            if self._cancelled or self._expired:
+                return
+
+            previous = self._waiter_results.get(key)
+
+            # a result that arrives after its key timed out is too late, and a
+            # timeout that fires after its key has a result is stale.
+            if previous and (isinstance(previous[1], PlanTimeout) or isinstance(exception, PlanTimeout)):
+                return
+
+            self._waiter_results[key] = (result, exception)
+            self._flagged.discard(key)
+            timeouts = [self._timeouts.pop(key, None)]
+
+            for waiter in self._waiters.pop(key, ()):
+                # quorum waiters count successes, and run once the quorum is met or
+                # once too many keys have failed for it to be; past that, they
+                # keep counting but don't run again.
+                if waiter.failures_allowed is not None and exception is not None:
+                    waiter.failures_allowed -= 1
+                    ready = waiter.failures_allowed == -1 and waiter.remaining > 0
+                else:
+                    waiter.remaining -= 1
+                    ready = waiter.remaining == 0 and (waiter.failures_allowed is None or waiter.failures_allowed >= 0)
+
+                if ready:
+                    self._ready.append(waiter)
+
+            if not self._flagged and not self._waiters:
+                timeouts.append(self._timeouts.pop(None, None))
+
+            schedule = bool(self._ready) and not self._drain_scheduled
+
+            if schedule:
+                self._drain_scheduled = True
+
+        for timeout in timeouts:
+            if timeout is not None:
+                self._ioloop.remove_timeout(timeout)
+
+        if schedule:
+            self._ioloop.add_callback(self._drain_callback)
 
-    def _next_in_callback_queue(self):
+    def _drain(self):
         try:
-            callback = self._callback_queue.popleft()
-        except IndexError:
-            pass
-        else:
-            callback()
-            self._ioloop.add_callback(self._next_callback)
+            for i in xrange(self.max_waiters_per_turn):
+                with self._lock:
+                    if not self._ready:
+                        break
+                    waiter = self._ready.popleft()
+
+                waiter.callback(WaiterResult(waiter.keys, self._waiter_results))
+        finally:
+            with self._lock:
+                self._drain_scheduled = bool(self._ready)
+
+            if self._drain_scheduled:
+                self._ioloop.add_callback(self._drain_callback)
+
+
+class _Waiter(object):
+    __slots__ = ('keys', 'callback', 'remaining', 'failures_allowed')
+
+    def __init__(self, keys, callback, remaining, failures_allowed = None):
+        self.keys = keys
+        self.callback = callback
+        self.remaining = remaining
+        self.failures_allowed = failures_allowed
 
 
 class WaiterResult(object):
@@ -115,10 +619,39 @@ class WaiterResult(object):
         (result, exception) = self.results[self.keys[index]]
 
         if exception:
-            raise exception, None, exception.exc_info[2]
+            exc_info = getattr(exception, 'exc_info', None)
+
+            if exc_info:
+                raise exception, None, exc_info[2]
+
+            raise exception
 
         return result
 
+    def done(self, index = 0):
+        return self.keys[index] in self.results
+
+    def succeeded(self, index = 0):
+        return self.done(index) and self.results[self.keys[index]][1] is None
+
+    def timed_out(self, index = 0):
+        (result, exception) = self.results[self.keys[index]]
+        return isinstance(exception, PlanTimeout)
+
+    def skipped(self, index = 0):
+        (result, exception) = self.results[self.keys[index]]
+        return isinstance(exception, PlanSkipped)
+
+class PlanTimeout(RuntimeError):
+    def __init__(self, key):
+        self.key = key
+        super(PlanTimeout, self).__init__("Timed out waiting for {0!r}.".format(key))
+
+class PlanSkipped(RuntimeError):
+    def __init__(self, key):
+        self.key = key
+        super(PlanSkipped, self).__init__("Skipped {0!r}, since enough others succeeded.".format(key))
+
 class _WaiterException(RuntimeError):
     def __init__(self, exc_info):
         self.exc_info = exc_info
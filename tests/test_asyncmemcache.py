@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_asyncmemcache.py
+
+Runs shrapnel.asyncmemcache.Client against shrapnel.fakememcache.Server:
+
+    python -m unittest discover -s tests
+"""
+
+import socket
+import time
+import unittest
+import tornado.ioloop
+from shrapnel import asyncmemcache, fakememcache
+
+
+class ClientTest(unittest.TestCase):
+    def setUp(self):
+        self.server = fakememcache.Server().start()
+        self.io_loop = tornado.ioloop.IOLoop()
+        self.results = []
+
+    def tearDown(self):
+        self.server.stop()
+
+    def client(self, servers = None, **kwargs):
+        return asyncmemcache.Client(servers or self.server.servers, io_loop = self.io_loop, **kwargs)
+
+    def collect(self, name):
+        return lambda result: self.results.append((name, result))
+
+    def run_until(self, count, timeout = 5):
+        def check():
+            if len(self.results) >= count or time.time() > deadline:
+                self.io_loop.stop()
+            else:
+                self.io_loop.add_timeout(time.time() + 0.01, check)
+
+        deadline = time.time() + timeout
+        self.io_loop.add_callback(check)
+        self.io_loop.start()
+        return self.results
+
+    def test_commands(self):
+        # one connection, so that responses arrive in order.
+        mc = self.client(pool_size = 1)
+        mc.set('str', 'value', callback = self.collect('set'))
+        mc.set('int', 42, callback = self.collect('set'))
+        mc.set('pickled', dict(a = [1, 2]), callback = self.collect('set'))
+        mc.add('str', 'other', callback = self.collect('add'))
+        mc.get('str', self.collect('str'))
+        mc.get_multi(['int', 'pickled', 'missing'], self.collect('multi'))
+        mc.delete('str', callback = self.collect('delete'))
+        mc.get('str', self.collect('deleted'))
+
+        self.assertEqual(self.run_until(8), [
+            ('set', True),
+            ('set', True),
+            ('set', True),
+            ('add', False),
+            ('str', 'value'),
+            ('multi', dict(int = 42, pickled = dict(a = [1, 2]))),
+            ('delete', True),
+            ('deleted', None),
+        ])
+
+    def test_raising_callback_releases_connection(self):
+        mc = self.client(pool_size = 1)
+
+        def raising(result):
+            self.results.append(('raising', result))
+            raise RuntimeError("callback bug")
+
+        mc.set('key', 'value', callback = self.collect('set'))
+        mc.get('key', raising)
+        mc.get('key', self.collect('get'))
+
+        self.assertEqual(self.run_until(3)[-1], ('get', 'value'))
+
+    def test_bad_keys(self):
+        mc = self.client()
+
+        for key in ['x 0 0 1\r\nZ\r\nflush_all', 'a b', 'a' * 251, u'unicode', '']:
+            self.assertRaises(asyncmemcache.MemcachedKeyError, mc.set, key, 'value')
+
+        self.assertRaises(asyncmemcache.MemcachedKeyError, mc.get_multi, ['ok', 'not ok'], self.collect('multi'))
+        self.assertEqual(self.server.commands, [])
+
+    def test_unreachable_server(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        address = "{0[0]}:{0[1]}".format(sock.getsockname())
+        sock.close()
+
+        mc = self.client([address], connect_timeout = 0.5)
+        mc.get('key', self.collect('get'))
+        mc.set('key', 'value', callback = self.collect('set'))
+
+        self.assertEqual(self.run_until(2), [('get', None), ('set', False)])
+
+    def test_unresponsive_server(self):
+        # the listen backlog accepts connections, but nothing ever answers.
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(5)
+        address = "{0[0]}:{0[1]}".format(sock.getsockname())
+
+        try:
+            mc = self.client([address], pool_size = 1, command_timeout = 0.2)
+            mc.get('key', self.collect('get'))
+            mc.set('key', 'value', callback = self.collect('set'))
+            self.assertEqual(self.run_until(2), [('get', None), ('set', False)])
+        finally:
+            sock.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_db.py
+
+Runs shrapnel.db.ConnectionPool and transaction against sqlite3:
+
+    python -m unittest discover -s tests
+"""
+
+import os
+import sqlite3
+import tempfile
+import unittest
+from shrapnel import db
+
+
+class PoolTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix = '.sqlite')
+        os.close(fd)
+        self.connect().execute("create table items (id integer primary key, name text)")
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def connect(self):
+        # autocommit, so that transaction's own begin and commit are the only ones.
+        return sqlite3.connect(self.path, timeout = 0.1, isolation_level = None)
+
+    def pool(self, **kwargs):
+        return db.ConnectionPool(self.connect, **kwargs)
+
+    def names(self):
+        return [row[0] for row in self.connect().execute("select name from items order by id")]
+
+    def test_checkout_and_checkin(self):
+        pool = self.pool(max_size = 2, checkout_timeout = 0.05)
+        first, second = pool.checkout(), pool.checkout()
+        self.assertTrue(first is not second)
+        self.assertEqual(pool.stats()['checked_out'], 2)
+        self.assertRaises(db.PoolTimeout, pool.checkout)
+
+        pool.checkin(first)
+        self.assertTrue(pool.checkout() is first)
+        self.assertEqual(pool.stats()['created'], 2)
+
+    def test_min_size_prefill(self):
+        pool = self.pool(min_size = 3)
+        self.assertEqual((pool.stats()['created'], pool.stats()['idle']), (3, 3))
+        self.assertRaises(ValueError, self.pool, min_size = 3, max_size = 2)
+
+    def test_idle_eviction(self):
+        pool = self.pool(min_size = 1, idle_timeout = 0)
+
+        for connection in [pool.checkout() for i in xrange(3)]:
+            pool.checkin(connection)
+
+        pool.checkin(pool.checkout())
+        stats = pool.stats()
+        self.assertEqual((stats['size'], stats['idle'], stats['discarded']), (1, 1, 2))
+
+    def test_discard_on_disconnect(self):
+        pool = self.pool()
+        connection = pool.checkout()
+        connection.close()
+        pool.checkin(connection)
+
+        # sqlite's "closed database" error counts as a lost connection.
+        self.assertRaises(sqlite3.ProgrammingError, pool.execute, "select 1")
+        self.assertEqual((pool.stats()['size'], pool.stats()['discarded']), (0, 1))
+
+        self.assertEqual(pool.execute("select 1").fetchall(), [(1,)])
+        self.assertEqual(pool.stats()['created'], 2)
+
+    def test_transaction_retries(self):
+        pool = self.pool()
+        attempts = []
+
+        @db.transaction(retries = 3, backoff = 0)
+        def add(name):
+            yield pool
+            pool.execute("insert into items (name) values (?)", (name,))
+            attempts.append(name)
+
+            if len(attempts) == 1:
+                raise sqlite3.OperationalError("database is locked")
+
+            yield name
+
+        self.assertEqual(add('a'), 'a')
+        self.assertEqual(attempts, ['a', 'a'])
+        self.assertEqual(self.names(), ['a'])
+
+    def test_transaction_rolls_back(self):
+        pool = self.pool()
+
+        @db.transaction(retries = 3, backoff = 0)
+        def add(name):
+            yield pool
+            pool.execute("insert into items (name) values (?)", (name,))
+            raise ValueError("not retryable")
+
+        self.assertRaises(ValueError, add, 'a')
+        self.assertEqual(self.names(), [])
+        self.assertEqual(pool.stats()['checked_out'], 0)
+
+    def test_nested_transaction_joins(self):
+        # with a single connection, an inner transaction that checked out its own would hang.
+        pool = self.pool(max_size = 1, checkout_timeout = 0.5)
+
+        @db.transaction()
+        def rename(name):
+            yield pool
+            pool.execute("update items set name = ? where id = 1", (name,))
+            yield name
+
+        @db.transaction()
+        def add_and_rename(name, fail = False):
+            yield pool
+            pool.execute("insert into items (id, name) values (1, ?)", (name,))
+            rename(name + '!')
+
+            if fail:
+                raise ValueError("outer failure")
+
+            yield name
+
+        self.assertRaises(ValueError, add_and_rename, 'a', fail = True)
+        self.assertEqual(self.names(), [])
+
+        add_and_rename('b')
+        self.assertEqual(self.names(), ['b!'])
+        self.assertEqual(pool.stats()['created'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()